@@ -1,6 +1,7 @@
+import numpy as np
 from torchvision import transforms
-from torchvision.datasets import CIFAR10, CIFAR100
-from torch.utils.data import Dataset, random_split
+from torch.utils.data import Dataset
+from data_store import CIFARStore, to_uint8_tensor
 import os
 
 # DATA_ROOT_PATH = r"F:\MTech_IIT_Jodhpur\3rd_Sem\DL-Ops\Project\DLOps_Project\DataPrep\datasets"
@@ -11,36 +12,35 @@ os.makedirs(DATA_ROOT_PATH, exist_ok=True)
 
 
 class ClassiferData(Dataset):
-    def __init__(self, dataset_name, task):
+    def __init__(self, dataset_name, task, val_fraction=0.2, seed=0):
         valid_models = ["cifar10", "cifar100"]
         if dataset_name.lower() not in valid_models:
             raise ValueError(f"The data should be in {valid_models}")
 
-        data_src = CIFAR10 if dataset_name.lower() == "cifar10" else CIFAR100
-
-        c_train = data_src(DATA_ROOT_PATH, download=True, train=True)
-        c_train, c_val = random_split(c_train, [0.8, 0.2])
-        c_train = c_train.dataset
-        c_val = c_val.dataset
-        c_test = data_src(DATA_ROOT_PATH, download=True, train=False)
+        # index-based views into the memory-mapped store, nothing is copied per split
+        self.store = CIFARStore(dataset_name, DATA_ROOT_PATH)
+        c_train, c_val = self.store.split_indices(val_fraction, seed)
+        c_test = self.store.test_indices()
         if task.strip().lower() == "train":
-            self.all_img_np = c_train.data
-            self.labels = c_train.targets
+            self.indices = c_train
         elif task.strip().lower() == "val":
-            self.all_img_np = c_val.data
-            self.labels = c_val.targets
+            self.indices = c_val
         else:
-            self.all_img_np = c_test.data
-            self.labels = c_test.targets
+            self.indices = c_test
+        self.labels = self.store.labels[self.indices]
 
         self.no_transforms = transforms.Compose([
-            transforms.ToTensor()
+            transforms.Lambda(to_uint8_tensor)
         ])
 
+    @property
+    def all_img_np(self):
+        return self.store.images
+
     def __len__(self):
-        return len(self.all_img_np)
+        return len(self.indices)
 
     def __getitem__(self, idx_):
-        img = self.no_transforms(self.all_img_np[idx_])
-        label = self.labels[idx_]
+        img = self.no_transforms(np.array(self.all_img_np[self.indices[idx_]]))
+        label = int(self.labels[idx_])
         return img, label
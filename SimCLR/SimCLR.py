@@ -1,16 +1,28 @@
+import contextlib
+import time
 import numpy as np
 import torch
 from torchvision.models import resnet18, ResNet18_Weights
 import torch.nn.functional as F
+from torchvision import transforms
 import os
-from torch.utils.data import DataLoader
-from SimCLR_Data import SimCLRDataset
+from torch.utils.data import DataLoader, Subset
+from torch.nn.parallel import DistributedDataParallel
+from SimCLR_Data import SimCLRDataset, EpochBatchSampler, seed_worker
 from Classifier_data import ClassiferData
 from SimCLRLoss import NTXent
+from feature_cache import FeatureCache
+from knn_monitor import KNNMonitor
+from prefix_cache import PrefixCache
+from distributed import is_distributed, is_main_process, get_rank, get_world_size, gather_objects, barrier
+from checkpoint import (save_checkpoint, load_checkpoint, torch_save_atomic, load_state, module_state,
+                        load_module_state, rng_state, set_rng_state, CheckpointWriter,
+                        PRETEXT_CHECKPOINT, CLASSIFIER_CHECKPOINT, TRAINING_STATE)
+from perf import autocast_dtype, autocast, grad_scaler, StepTimer
 from torch.optim import Adam, RMSprop, Adagrad
 from tqdm import tqdm
 from torch.nn import CrossEntropyLoss
-from sklearn.metrics import top_k_accuracy_score
+from metrics import MetricsAccumulator, evaluate, eval_dataloader
 from torch.autograd import Variable
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -19,35 +31,116 @@ DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 SAVE_DIR = os.path.join('./SimCLR')
 os.makedirs(SAVE_DIR, exist_ok=True)
+CHECKPOINT_DIR = os.path.join(SAVE_DIR, "checkpoints")
+
+
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    # momentum 0 keeps the running mean/var untouched while BatchNorm still normalizes with batch stats
+    bns = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    momentums = [bn.momentum for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, momentum in zip(bns, momentums):
+            bn.momentum = momentum
+
+
+ENCODER_ARCHS = ["imagenet", "cifar"]
+# torchvision's resnet18 forward as blocks from the input side, freezing always covers a prefix of them
+RESNET_BLOCKS = [["conv1", "bn1", "relu", "maxpool"], ["layer1"], ["layer2"], ["layer3"], ["layer4"],
+                 ["avgpool", "fc"]]
+
+
+def build_resnet18(encoder_arch="imagenet", weights=ResNet18_Weights.DEFAULT):
+    if encoder_arch not in ENCODER_ARCHS:
+        raise ValueError(f"The encoder arch should be in {ENCODER_ARCHS}")
+    model = resnet18(weights=weights)
+    if encoder_arch == "cifar":
+        # 3x3 stride 1 stem without maxpool, so 32x32 images keep their resolution into layer1
+        model.conv1 = torch.nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=False)
+        model.maxpool = torch.nn.Identity()
+    return model
 
 
 class ResNet18enc:
-    def __init__(self, unfreez_layers=0):
+    def __init__(self, unfreez_layers=0, encoder_arch="imagenet"):
         weights = ResNet18_Weights.DEFAULT
-        self.model = resnet18(weights=weights)
+        self.encoder_arch = encoder_arch
+        self.model = build_resnet18(encoder_arch, weights)
 
         self.model = self.model.to(DEVICE)
-        self.__preprocess = weights.transforms()
-
-        num_param_layers = len(list(self.model.parameters()))
-        if unfreez_layers == -1:
-            unfreez_layers = num_param_layers
+        if encoder_arch == "cifar":
+            # native 32x32 input, only the imagenet normalization is kept
+            imagenet_preprocess = weights.transforms()
+            self.__preprocess = transforms.Compose([
+                transforms.ConvertImageDtype(torch.float),
+                transforms.Normalize(imagenet_preprocess.mean, imagenet_preprocess.std)
+            ])
+        else:
+            self.__preprocess = weights.transforms()
+        self.channels_last = False
+        self.set_trainable_blocks(unfreez_layers)
+
+    def set_trainable_blocks(self, n_blocks):
+        # the last n_blocks of RESNET_BLOCKS train, -1 trains all of them. The frozen prefix runs
+        # without autograd and with its BatchNorm layers on their running stats
+        if n_blocks == -1:
+            n_blocks = len(RESNET_BLOCKS)
+        if not 0 <= n_blocks <= len(RESNET_BLOCKS):
+            raise ValueError(f"The number of trainable blocks should be in [-1, {len(RESNET_BLOCKS)}]")
+        self.n_frozen = len(RESNET_BLOCKS) - n_blocks
+        for block_no, names in enumerate(RESNET_BLOCKS):
+            for name in names:
+                for param in getattr(self.model, name).parameters():
+                    param.requires_grad = block_no >= self.n_frozen
+        self.prefix_cache = None
+
+    def enable_prefix_cache(self, n_items, max_mb):
+        # only valid while the prefix stays frozen, set_trainable_blocks drops it
+        self.prefix_cache = PrefixCache(n_items, max_mb) if self.n_frozen > 0 else None
+
+    def __run_blocks(self, x, blocks):
+        for names in blocks:
+            for name in names:
+                x = getattr(self.model, name)(x)
+                if name == "avgpool":
+                    x = torch.flatten(x, 1)
+        return x
 
-        freez_layers = num_param_layers - unfreez_layers
-        for p_idx, param in enumerate(self.model.parameters()):
-            if p_idx < freez_layers:
-                param.requires_grad = False
+    def forward_features(self, x, cache_keys=None):
+        if self.n_frozen == 0:
+            return self.model(x)
+        prefix = RESNET_BLOCKS[:self.n_frozen]
+        for name in sum(prefix, []):
+            getattr(self.model, name).eval()
+        with torch.no_grad():
+            if self.prefix_cache is not None and cache_keys is not None:
+                h = self.prefix_cache.run(x, cache_keys, lambda x_: self.__run_blocks(x_, prefix))
             else:
-                param.requires_grad = True
+                h = self.__run_blocks(x, prefix)
+        return self.__run_blocks(h, RESNET_BLOCKS[self.n_frozen:])
+
+    def to_channels_last(self):
+        self.model = self.model.to(memory_format=torch.channels_last)
+        self.channels_last = True
 
-    def __call__(self, x):
+    def preprocess(self, x):
+        # uint8 or float batches go to the device first (asynchronously when pinned),
+        # the resize and normalization then run there instead of on the main process's cpu thread
         if x.ndim == 3:
             x = x.unsqueeze(0)
-        x = self.__preprocess(x).to(DEVICE)
-        # print(x.shape)
-        # transforms.Resize(224)(x)
-        x = x.to(DEVICE)
-        x_op = self.model(x)
+        x = x.to(DEVICE, non_blocking=True)
+        x = transforms.functional.convert_image_dtype(x, torch.float)
+        x = self.__preprocess(x)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def __call__(self, x, cache_keys=None):
+        x_op = self.forward_features(self.preprocess(x), cache_keys)
         return x_op
 
 
@@ -66,33 +159,44 @@ class ProjectionHead(torch.nn.Module):
         return x
 
 
+class PretextNet(torch.nn.Module):
+    # encoder and projection head of a SimCLR as one module, the unit DistributedDataParallel wraps.
+    # The parameters are shared with the SimCLR, so its checkpoints stay unchanged
+    def __init__(self, simclr):
+        super(PretextNet, self).__init__()
+        self.base_enc = simclr.base_enc
+        self.encoder = simclr.base_enc.model
+        self.projection_head = simclr.projection_head
+
+    def forward(self, x, cache_keys=None):
+        # runs through base_enc for its frozen prefix handling, self.encoder registers the same parameters
+        return self.projection_head(self.base_enc(x, cache_keys))
+
+
 class SimCLR:
-    def __init__(self, unfreezed_enc_layers=5, proj_head_dim=128):
-        self.base_enc = ResNet18enc(unfreezed_enc_layers)
+    def __init__(self, unfreezed_enc_layers=2, proj_head_dim=128, encoder_arch="imagenet"):
+        self.base_enc = ResNet18enc(unfreezed_enc_layers, encoder_arch)
         self.projection_head = ProjectionHead(proj_head_dim).to(DEVICE)
 
-    def __call__(self, x):
-        f = self.base_enc(x)
+    def __call__(self, x, cache_keys=None):
+        f = self.base_enc(x, cache_keys)
         g = self.projection_head(f)
         return g
 
+    def modules(self):
+        return {"encoder": self.base_enc.model, "projection_head": self.projection_head}
+
     def save_model(self, save_path):
-        enc_state_dict_path = os.path.join(save_path, "encoder_load_state")
-        proj_state_dict_path = os.path.join(save_path, "projection_head_load_state")
-        torch.save(self.base_enc.model.state_dict(), enc_state_dict_path)
-        torch.save(self.projection_head.state_dict(), proj_state_dict_path)
+        save_checkpoint(os.path.join(save_path, PRETEXT_CHECKPOINT), self.modules())
 
     def load_model(self, save_path):
-        enc_state_dict_path = os.path.join(save_path, "encoder_load_state")
-        proj_state_dict_path = os.path.join(save_path, "projection_head_load_state")
-        self.base_enc.model.load_state_dict(torch.load(enc_state_dict_path, map_location=DEVICE))
-        self.projection_head.load_state_dict(torch.load(proj_state_dict_path, map_location=DEVICE))
+        load_checkpoint(os.path.join(save_path, PRETEXT_CHECKPOINT), self.modules())
 
 
 class Classifier(torch.nn.Module):
-    def __init__(self, n_classes, unfreezed_enc_layers=0, enc_dim=128):
+    def __init__(self, n_classes, unfreezed_enc_layers=0, enc_dim=128, encoder_arch="imagenet"):
         super(Classifier, self).__init__()
-        self.feature_extractor = SimCLR(unfreezed_enc_layers, enc_dim)
+        self.feature_extractor = SimCLR(unfreezed_enc_layers, enc_dim, encoder_arch)
         self.n_classes = n_classes
         self.clf_layer1 = torch.nn.Linear(1000, enc_dim).to(DEVICE)
         self.clf_layer2 = torch.nn.Linear(enc_dim, n_classes).to(DEVICE)
@@ -101,7 +205,9 @@ class Classifier(torch.nn.Module):
     def forward(self, x):
         x = x.to(DEVICE)
         x = self.feature_extractor.base_enc(x)
+        return self.head(x)
 
+    def head(self, x):
         # layer1 of classifier
         x = self.clf_layer1(x)
         x = self.activation1(x)
@@ -112,22 +218,44 @@ class Classifier(torch.nn.Module):
 
     def pretext_train(self, dataset_name,
                       epochs, enc_lr, proj_lr, fine_tune_layers=-1, temperature=0.05,
-                      batch_size=16):
-        dataset = SimCLRDataset(dataset_name, batch_size)
-        dataloader = DataLoader(dataset, batch_size=1,
-                                num_workers=3,
-                                pin_memory=True
+                      batch_size=16, augment="torchvision", num_workers=3, prefetch_factor=2, seed=0,
+                      precision="fp32", channels_last=False, micro_batch_size=None, log_interval=10,
+                      checkpoint_every=None, keep_checkpoints=3, resume=False,
+                      knn_every=None, knn_bank_size=10000, knn_queries=2000, knn_k=200, prefix_cache_mb=0):
+        # the first rank downloads and converts the data store, the others wait and only open it
+        if not is_main_process():
+            barrier()
+        dataset = SimCLRDataset(dataset_name, batch_size, augment=augment)
+        if is_main_process():
+            barrier()
+        # the sampler hands whole index batches to the workers, so batch_size=None turns off re-collation
+        # with several processes batch_size is per rank, every rank reads its own shard of each epoch
+        rank, world_size = get_rank(), get_world_size()
+        sampler = EpochBatchSampler(len(dataset), batch_size, seed=seed, rank=rank, world_size=world_size)
+        dataloader = DataLoader(dataset, batch_size=None,
+                                sampler=sampler,
+                                num_workers=num_workers,
+                                pin_memory=True,
+                                persistent_workers=num_workers > 0,
+                                prefetch_factor=prefetch_factor if num_workers > 0 else None,
+                                worker_init_fn=seed_worker,
+                                generator=torch.Generator().manual_seed(seed + rank)
                                 )
+        if is_distributed():
+            # every rank starts from the same default seed, their augmentations must differ
+            torch.manual_seed(seed + rank)
 
         model = self.feature_extractor
         criterion = NTXent(batch_size, temperature)
 
-        optim_list = [{"params": model.base_enc.model.parameters(), "lr": proj_lr}]
-        if fine_tune_layers == -1:
-            fine_tune_layers = len(list(model.base_enc.model.parameters()))
-        for i in range(1, fine_tune_layers + 1):
-            optim_list.append({"params": list(model.base_enc.model.parameters())[-i],
-                               "lr": enc_lr})
+        # fine_tune_layers trailing encoder blocks train at enc_lr (-1 for all, None keeps the constructor's),
+        # the projection head at proj_lr
+        if fine_tune_layers is not None:
+            model.base_enc.set_trainable_blocks(fine_tune_layers)
+        optim_list = [{"params": list(model.projection_head.parameters()), "lr": proj_lr}]
+        enc_params = [param for param in model.base_enc.model.parameters() if param.requires_grad]
+        if enc_params:
+            optim_list.append({"params": enc_params, "lr": enc_lr})
 
         # print(optim_list)
         optim = Adam(
@@ -135,46 +263,195 @@ class Classifier(torch.nn.Module):
             lr=proj_lr,
             weight_decay=1e-06
         )
+        amp_dtype = autocast_dtype(precision, DEVICE)
+        scaler = grad_scaler(DEVICE, amp_dtype)
+        if channels_last:
+            model.base_enc.to_channels_last()
         model.projection_head.train()
         model.base_enc.model.train()
+        net = PretextNet(model)
+        if is_distributed():
+            device_ids = [torch.cuda.current_device()] if DEVICE.type == "cuda" else None
+            net = DistributedDataParallel(net, device_ids=device_ids)
+
+        # checkpoints after every epoch and every checkpoint_every steps, written in the background
+        writer = CheckpointWriter(CHECKPOINT_DIR, keep=keep_checkpoints)
+        start_epoch, start_batch = 0, 0
+        if resume and writer.latest() is not None:
+            start_epoch, start_batch = self.__load_training_state(writer.latest(), optim, scaler, world_size)
+            if is_main_process():
+                print(f"resuming from {writer.latest()} at epoch {start_epoch} batch {start_batch}")
+                # the model, optimizer, sampler position and main process RNG are restored, the DataLoader
+                # workers start over from their initial seeds, so only num_workers=0 replays the same augmentations
+                if num_workers > 0:
+                    print(f"augmentations after the resume differ from an uninterrupted run "
+                          f"(num_workers={num_workers})")
+
+        # the original view of an image is the same every epoch, so its frozen-prefix output can be kept
+        if prefix_cache_mb:
+            model.base_enc.enable_prefix_cache(len(dataset), prefix_cache_mb)
+
+        # weighted kNN accuracy every knn_every epochs, from the first process's shard of the data
+        monitor = None
+        if knn_every and is_main_process():
+            monitor, knn_dataloader = self.__knn_monitor(dataset, dataset_name, knn_bank_size, knn_queries, knn_k,
+                                                         batch_size, seed)
 
         # gc.collect()
         # torch.cuda.empty_cache()
-        for epoch in tqdm(range(epochs)):
-            for batch_idx, (original_tensors, aug_tensors) in enumerate(dataloader, start=1):
-                optim.zero_grad()
-                original_tensors = original_tensors.squeeze(dim=0)
-                aug_tensors = aug_tensors.squeeze(dim=0)
-                original_Zs = model(original_tensors)
-                aug_Zs = model(aug_tensors)
-                loss = criterion(original_Zs, aug_Zs)
-                loss.backward()
-                optim.step()
-                print(f"epoch {epoch + 1} batch - {batch_idx} loss = {loss.item()}")
-
-            print(f"epoch {epoch} ---- {loss.item()}")
-        model.save_model(SAVE_DIR)
-        print("model saved")
+        metrics = MetricsAccumulator(DEVICE, topk=())
+        for epoch in tqdm(range(start_epoch, epochs), disable=not is_main_process()):
+            sampler.set_epoch(epoch, start_batch)
+            timer = StepTimer(DEVICE)
+            metrics.reset()
+            need_indices = monitor is not None or model.base_enc.prefix_cache is not None
+            epoch_indices = sampler.epoch_indices() if need_indices else None
+            for batch_idx, (original_tensors, aug_tensors) in enumerate(dataloader, start=start_batch + 1):
+                batch_indices = None
+                if need_indices:
+                    batch_indices = epoch_indices[(batch_idx - 1) * batch_size:batch_idx * batch_size]
+                loss = self.pretext_step(criterion, optim, scaler, amp_dtype, original_tensors, aug_tensors,
+                                         micro_batch_size, net, monitor, batch_indices)
+                metrics.update(loss, n=len(original_tensors))
+                timer.step()
+                # reading the loss syncs with the device, so it only happens every log_interval batches
+                if log_interval and batch_idx % log_interval == 0 and is_main_process():
+                    print(f"epoch {epoch + 1} batch - {batch_idx} loss = {metrics.compute()['loss']}")
+                step = epoch * len(sampler) + batch_idx
+                if checkpoint_every and step % checkpoint_every == 0 and batch_idx < len(sampler):
+                    self.__save_training_state(writer, step, optim, scaler, epoch, batch_idx)
+            start_batch = 0
+
+            self.__save_training_state(writer, (epoch + 1) * len(sampler), optim, scaler, epoch + 1, 0)
+            if is_main_process():
+                print(f"epoch {epoch} ---- {metrics.compute()['loss']} ({precision}, channels_last={channels_last}) "
+                      f"{timer.summary()}")
+            knn_due = (epoch + 1) % knn_every == 0 or epoch + 1 == epochs if knn_every else False
+            if monitor is not None and monitor.bank is not None and knn_due:
+                st = time.perf_counter()
+                knn_stats = evaluate(lambda x: monitor.votes(model(x)), knn_dataloader, DEVICE,
+                                     modules=[model.base_enc.model, model.projection_head], topk=(1, 5),
+                                     amp_dtype=amp_dtype)
+                print(f"epoch {epoch} ---- knn top1: {knn_stats['top1']} top5: {knn_stats['top5']} "
+                      f"({time.perf_counter() - st:.1f}s)")
+        writer.wait()
+        if is_main_process():
+            model.save_model(SAVE_DIR)
+            print("model saved")
+
+    def __knn_monitor(self, dataset, dataset_name, bank_size, n_queries, k, batch_size, seed):
+        # labeled bank from the train images, queries from the test images, both fixed for the run
+        store = dataset.store
+        rng = np.random.default_rng(seed)
+        train_indices = store.train_indices()
+        bank_indices = np.sort(rng.choice(train_indices, min(bank_size, len(train_indices)), replace=False))
+        n_classes = int(np.max(store.labels)) + 1
+        monitor = KNNMonitor(bank_indices, store.labels[bank_indices], len(dataset), n_classes, DEVICE, k=k)
+        test_dataset = ClassiferData(dataset_name, "test")
+        queries = Subset(test_dataset, np.sort(rng.choice(len(test_dataset), min(n_queries, len(test_dataset)),
+                                                          replace=False)))
+        return monitor, eval_dataloader(queries, 2 * batch_size, num_workers=0)
+
+    def __save_training_state(self, writer, step, optim, scaler, epoch, batch):
+        # epoch/batch is where training continues, batch counts the batches of that epoch already trained on.
+        # Every rank takes part in gathering the rng states, only the first one writes
+        rng = gather_objects(rng_state())
+        if is_main_process():
+            writer.save(step, {"model": module_state(self.feature_extractor.modules()), "optim": optim.state_dict(),
+                               "scaler": scaler.state_dict(), "rng": rng,
+                               "sampler": {"epoch": epoch, "batch": batch, "world_size": get_world_size()}})
+
+    def __load_training_state(self, path, optim, scaler, world_size):
+        state = load_state(path, weights_only=False)
+        if state["sampler"]["world_size"] != world_size:
+            raise ValueError(f"The checkpoint was written by {state['sampler']['world_size']} processes, "
+                             f"resume with the same number of processes")
+        load_module_state(state["model"], self.feature_extractor.modules())
+        optim.load_state_dict(state["optim"])
+        scaler.load_state_dict(state["scaler"])
+        set_rng_state(state["rng"][get_rank()])
+        return state["sampler"]["epoch"], state["sampler"]["batch"]
+
+    def pretext_step(self, criterion, optim, scaler, amp_dtype, original_tensors, aug_tensors,
+                     micro_batch_size=None, net=None, monitor=None, batch_indices=None):
+        # both views go through the encoder as one 2N batch and are only split again for NT-Xent,
+        # they are concatenated on the device so the pinned host copies stay asynchronous
+        n = len(original_tensors)
+        views = torch.cat((original_tensors.to(DEVICE, non_blocking=True),
+                           aug_tensors.to(DEVICE, non_blocking=True)))
+        model = net if net is not None else self.feature_extractor
+        # prefix cache keys, only the original view repeats between epochs
+        keys = None
+        if batch_indices is not None:
+            keys = torch.cat((torch.as_tensor(batch_indices), torch.full((n,), -1)))
+        if micro_batch_size is not None and micro_batch_size < len(views):
+            return self.__grad_cache_step(criterion, optim, scaler, amp_dtype, views, n, micro_batch_size, model,
+                                          monitor, batch_indices, keys)
+        optim.zero_grad()
+        with autocast(DEVICE, amp_dtype):
+            original_Zs, aug_Zs = model(views, keys).split(n)
+            loss = criterion(original_Zs, aug_Zs)
+        if monitor is not None:
+            monitor.update(batch_indices, original_Zs)
+        scaler.scale(loss).backward()
+        scaler.step(optim)
+        scaler.update()
+        return loss
+
+    def __grad_cache_step(self, criterion, optim, scaler, amp_dtype, views, n, micro_batch_size, model,
+                          monitor=None, batch_indices=None, keys=None):
+        # gradient caching: the loss sees the whole batch, but only one micro batch of activations is alive
+        optim.zero_grad()
+
+        # 1. embeddings of every micro batch, without building a graph
+        key_chunks = keys.split(micro_batch_size) if keys is not None else [None] * len(views.split(micro_batch_size))
+        with torch.no_grad(), autocast(DEVICE, amp_dtype):
+            z = torch.cat([model(chunk, chunk_keys) for chunk, chunk_keys in zip(views.split(micro_batch_size),
+                                                                                 key_chunks)])
+        z = z.detach().requires_grad_()
+        if monitor is not None:
+            monitor.update(batch_indices, z[:n])
+
+        # 2. full NT-Xent over the cached embeddings, giving d(loss)/d(embedding)
+        with autocast(DEVICE, amp_dtype):
+            loss = criterion(*z.split(n))
+        scaler.scale(loss).backward()
+
+        # 3. replay each micro batch with a graph and push its slice of the embedding gradient through it,
+        # the BatchNorm running stats were already updated in step 1
+        # under DistributedDataParallel only the last replay all-reduces the accumulated gradients
+        chunks = list(zip(views.split(micro_batch_size), z.grad.split(micro_batch_size), key_chunks))
+        with _frozen_bn_stats(self.feature_extractor.base_enc.model):
+            for chunk_no, (chunk, z_grad, chunk_keys) in enumerate(chunks, start=1):
+                no_sync = isinstance(model, DistributedDataParallel) and chunk_no < len(chunks)
+                with model.no_sync() if no_sync else contextlib.nullcontext():
+                    with autocast(DEVICE, amp_dtype):
+                        z_chunk = model(chunk, chunk_keys)
+                    z_chunk.backward(z_grad)
+        scaler.step(optim)
+        scaler.update()
+        return loss.detach()
 
     def load_pretexted_model(self):
         self.feature_extractor.load_model(SAVE_DIR)
 
+    def checkpoint_modules(self):
+        return {**self.feature_extractor.modules(), "layer1": self.clf_layer1, "layer2": self.clf_layer2}
+
     def save_model(self):
-        self.feature_extractor.save_model(SAVE_DIR)
-        layer1_state_dict_path = os.path.join(SAVE_DIR, "layer1")
-        layer2_state_dict_path = os.path.join(SAVE_DIR, "layer2")
-        torch.save(self.clf_layer1.state_dict(), layer1_state_dict_path)
-        torch.save(self.clf_layer2.state_dict(), layer2_state_dict_path)
+        save_checkpoint(os.path.join(SAVE_DIR, CLASSIFIER_CHECKPOINT), self.checkpoint_modules())
 
     def load_model(self):
-        self.feature_extractor.load_model(SAVE_DIR)
-        layer1_state_dict_path = os.path.join(SAVE_DIR, "layer1")
-        layer2_state_dict_path = os.path.join(SAVE_DIR, "layer2")
-        self.clf_layer1.load_state_dict(torch.load(layer1_state_dict_path, map_location=DEVICE))
-        self.clf_layer2.load_state_dict(torch.load(layer2_state_dict_path, map_location=DEVICE))
+        load_checkpoint(os.path.join(SAVE_DIR, CLASSIFIER_CHECKPOINT), self.checkpoint_modules())
 
     def fine_tuning(self, dataset_name, epochs, clf_lr,
-                    batch_size=16):
+                    batch_size=16, precision="fp32", channels_last=False, cache_features=False, log_interval=10,
+                    eval_batch_size=None, eval_every=1):
+        if eval_every < 1:
+            raise ValueError("The eval_every should be at least 1")
+        eval_batch_size = eval_batch_size or 2 * batch_size
+        if cache_features:
+            return self.__fine_tune_cached(dataset_name, epochs, clf_lr, batch_size, eval_batch_size, eval_every)
         dataset = ClassiferData(dataset_name, "train")
         dataloader = DataLoader(dataset, batch_size=batch_size,
                                 num_workers=3,
@@ -183,13 +460,7 @@ class Classifier(torch.nn.Module):
                                 )
 
         val_dataset = ClassiferData(dataset_name, "val")
-        val_dataloader = DataLoader(
-            val_dataset,
-            batch_size=batch_size,
-            num_workers=3,
-            pin_memory=True,
-            shuffle=True
-            )
+        val_dataloader = eval_dataloader(val_dataset, eval_batch_size)
         num_of_batches = len(dataloader)
         cut_off_batch_cnt = int(num_of_batches * 0.01)
 
@@ -210,85 +481,112 @@ class Classifier(torch.nn.Module):
             weight_decay=1e-06
         )
 
+        amp_dtype = autocast_dtype(precision, DEVICE)
+        scaler = grad_scaler(DEVICE, amp_dtype)
+        if channels_last:
+            model.base_enc.to_channels_last()
         model.projection_head.train()
         model.base_enc.model.train()
 
+        train_metrics = MetricsAccumulator(DEVICE)
         for epoch in tqdm(range(epochs)):
+            timer = StepTimer(DEVICE)
             batch_no = 0
-            batch_losses = []
-            batch_accs = []
-            batch_accs_10 = []
+            train_metrics.reset()
             self.clf_layer1.train()
             self.clf_layer2.train()
             for batch_data, batch_label in dataloader:
                 if batch_no >= cut_off_batch_cnt:
                     break
-                batch_data = batch_data.to(DEVICE)
-                batch_label = batch_label.to(DEVICE)
+                batch_data = batch_data.to(DEVICE, non_blocking=True)
+                batch_label = batch_label.to(DEVICE, non_blocking=True)
                 optim.zero_grad()
-                z = model.base_enc(batch_data)
-                z = self.clf_layer1(z)
-                z = self.clf_layer2(z)
+                with autocast(DEVICE, amp_dtype):
+                    z = model.base_enc(batch_data)
+                    z = self.head(z)
+                    loss = criterion(z, batch_label)
+                scaler.scale(loss).backward()
+                scaler.step(optim)
+                scaler.update()
+                timer.step()
+                batch_no += 1
+                train_metrics.update(loss, z, batch_label)
+                if log_interval and batch_no % log_interval == 0:
+                    print(f"epoch {epoch + 1} batch - {batch_no} loss = {train_metrics.compute()['loss']}")
+
+            train_perf = timer.summary()
+            train_stats = train_metrics.compute()
+            val_log = ""
+            if self.__eval_due(epoch, epochs, eval_every):
+                val_stats = evaluate(lambda x: self.head(model.base_enc(x)), val_dataloader, DEVICE,
+                                     modules=[model.base_enc.model, self.clf_layer1, self.clf_layer2],
+                                     criterion=criterion, amp_dtype=amp_dtype)
+                val_log = f" Val_acc: {val_stats['top1']} Val_acc_top10: {val_stats['top10']}"
+            print(f"epoch {epoch} ---- {train_stats['loss']} \
+            train_acc: {train_stats['top1']} train_acc_top10: {train_stats['top10']}\n{val_log}\n\
+            ({precision}, channels_last={channels_last}) train {train_perf}\n")
+        self.save_model()
+        print("model saved")
+
+
+    @staticmethod
+    def __eval_due(epoch, epochs, eval_every):
+        # every eval_every epochs and always after the last one
+        return (epoch + 1) % eval_every == 0 or epoch + 1 == epochs
+
+    def __fine_tune_cached(self, dataset_name, epochs, clf_lr, batch_size, eval_batch_size, eval_every):
+        # the encoder is not in the optimizer, so its features are computed once and the head trains on them
+        cache = FeatureCache(self.feature_extractor.base_enc, dataset_name)
+        splits = {task: cache.features(task, ClassiferData(dataset_name, task), batch_size)
+                  for task in ["train", "val", "test"]}
+        train_x, train_y = splits["train"]
+
+        criterion = CrossEntropyLoss()
+        optim = Adam(
+            [{"params": list(self.clf_layer1.parameters()), "lr": clf_lr},
+             {"params": list(self.clf_layer2.parameters()), "lr": clf_lr}],
+            lr=clf_lr,
+            weight_decay=1e-06
+        )
+
+        train_metrics = MetricsAccumulator(DEVICE)
+        for epoch in tqdm(range(epochs)):
+            self.clf_layer1.train()
+            self.clf_layer2.train()
+            train_metrics.reset()
+            perm = np.random.permutation(len(train_x))
+            for st in range(0, len(perm), batch_size):
+                idxs = np.sort(perm[st:st + batch_size])
+                batch_data = torch.from_numpy(train_x[idxs]).to(DEVICE)
+                batch_label = torch.from_numpy(train_y[idxs]).to(DEVICE)
+                optim.zero_grad()
+                z = self.head(batch_data)
                 loss = criterion(z, batch_label)
                 loss.backward()
                 optim.step()
-                batch_no += 1
-                print(f"epoch {epoch + 1} batch - {batch_no} loss = {loss.item()}")
-                batch_losses.append(loss.item())
-
-                b_acc = top_k_accuracy_score(
-                    batch_label.cpu().numpy(),
-                    z.detach().cpu().numpy(),
-                    k=1,
-                    labels=list(range(self.n_classes))
-                )
-                batch_accs.append(b_acc)
-
-                b_acc_10 = top_k_accuracy_score(
-                    batch_label.cpu().numpy(),
-                    z.detach().cpu().numpy(),
-                    k=10,
-                    labels=list(range(self.n_classes))
-                )
-                batch_accs_10.append(b_acc_10)
-
-            self.clf_layer1.eval()
-            self.clf_layer2.eval()
-            v_batch_accs = []
-            v_batch_accs_10 = []
-            for batch_data, batch_label in val_dataloader:
-                batch_data = batch_data.to(DEVICE)
-                batch_label = batch_label.to(DEVICE)
-                z = model.base_enc(batch_data)
-                z = self.clf_layer1(z)
-                z = self.clf_layer2(z)
-                batch_no += 1
-
-                b_acc = top_k_accuracy_score(
-                    batch_label.cpu().numpy(),
-                    z.detach().cpu().numpy(),
-                    k=1,
-                    labels=list(range(self.n_classes))
-                )
-                v_batch_accs.append(b_acc)
-
-                b_acc_10 = top_k_accuracy_score(
-                    batch_label.cpu().numpy(),
-                    z.detach().cpu().numpy(),
-                    k=10,
-                    labels=list(range(self.n_classes))
-                )
-                v_batch_accs_10.append(b_acc_10)
-
-            print(f"epoch {epoch} ---- {np.mean(batch_losses)} \
-            train_acc: {np.mean(batch_accs)} train_acc_top10: {np.mean(batch_accs_10)}\n Val_acc:\
-            {np.mean(v_batch_accs)} Val_acc_top10: {np.mean(v_batch_accs_10)}\n")
+                train_metrics.update(loss, z, batch_label)
+
+            train_stats = train_metrics.compute()
+            val_log = ""
+            if self.__eval_due(epoch, epochs, eval_every):
+                val_stats = self.__cached_eval(*splits["val"], eval_batch_size)
+                val_log = f" Val_acc: {val_stats['top1']} Val_acc_top10: {val_stats['top10']}"
+            print(f"epoch {epoch} ---- {train_stats['loss']} \
+            train_acc: {train_stats['top1']} train_acc_top10: {train_stats['top10']}\n{val_log}\n")
+        test_stats = self.__cached_eval(*splits["test"], eval_batch_size)
+        print(f"Test_acc: {test_stats['top1']} Test_acc_top10: {test_stats['top10']}")
         self.save_model()
         print("model saved")
 
+    def __cached_eval(self, features, labels, batch_size):
+        batches = ((torch.from_numpy(np.array(features[st:st + batch_size])),
+                    torch.from_numpy(labels[st:st + batch_size])) for st in range(0, len(features), batch_size))
+        return evaluate(self.head, batches, DEVICE, modules=[self.clf_layer1, self.clf_layer2],
+                        criterion=CrossEntropyLoss())
+
 
 class Clssifier(torch.nn.Module):
-    def __init__(self, n_class, un_freeze_layers=2):
+    def __init__(self, n_class, un_freeze_layers=2, pretrained=True, encoder_arch="imagenet"):
         super(Clssifier, self).__init__()
         self.n_class = n_class
         assert un_freeze_layers >= 0 or un_freeze_layers is None
@@ -297,8 +595,10 @@ class Clssifier(torch.nn.Module):
         # chooseing the base classifier
         self.base_classifier_name = base_classifier
 
+        # the imagenet weights are not needed when a checkpoint is loaded right after
+        # encoder_arch has to match the arch the encoder checkpoint was trained with
         if base_classifier == "resnet18":
-            self.base_clf = resnet18(ResNet18_Weights.IMAGENET1K_V1)
+            self.base_clf = build_resnet18(encoder_arch, ResNet18_Weights.IMAGENET1K_V1 if pretrained else None)
 
         self.base_clf = self.base_clf.to(DEVICE)
         self.fc1 = torch.nn.Linear(1000, 128).to(DEVICE)
@@ -319,38 +619,27 @@ class Clssifier(torch.nn.Module):
                 param.requires_grad = False
 
     def forward(self, x):
+        if not x.is_floating_point():
+            x = x.float() / 255
         x = self.base_clf(x)
         x = torch.relu(self.fc1(x))
         x = self.fc2(x)
         return x
 
-    def __match_preds(self, y_pred, y_true):
-        max_idxs = torch.argmax(y_pred, dim=1)
-        matches = list((max_idxs == y_true).cpu().numpy())
-        return matches
+    def checkpoint_modules(self):
+        # same names as Classifier's checkpoint, so this loads what fine_tuning saved
+        return {"encoder": self.base_clf, "layer1": self.fc1, "layer2": self.fc2}
 
-    def load_model(self):
-        base_clf_state_dict_path = os.path.join(SAVE_DIR, "encoder_load_state")
-        layer1_state_dict_path = os.path.join(SAVE_DIR, "layer1")
-        layer2_state_dict_path = os.path.join(SAVE_DIR, "layer2")
-        optimizer_path = os.path.join(SAVE_DIR, "optim")
-
-        self.optim = Adam(self.parameters())
-        self.base_clf.load_state_dict(torch.load(base_clf_state_dict_path, map_location=DEVICE))
-        self.fc1.load_state_dict(torch.load(layer1_state_dict_path, map_location=DEVICE))
-        self.fc2.load_state_dict(torch.load(layer2_state_dict_path, map_location=DEVICE))
-        self.optim.load_state_dict(torch.load(optimizer_path, map_location=DEVICE))
+    def load_model(self, load_optim=True, save_path=SAVE_DIR):
+        load_checkpoint(os.path.join(save_path, CLASSIFIER_CHECKPOINT), self.checkpoint_modules())
+        # inference only needs the weights, the optimizer state is for resuming training
+        if load_optim:
+            self.optim = Adam(self.parameters())
+            self.optim.load_state_dict(load_state(os.path.join(save_path, TRAINING_STATE), DEVICE)["optim"])
 
     def save_model(self, save_path):
-        enc_state_dict_path = os.path.join(save_path, "encoder_load_state")
-        layer1_path = os.path.join(save_path, "layer1")
-        layer2_path = os.path.join(save_path, "layer2")
-        optimizer_path = os.path.join(save_path, "optim")
-
-        torch.save(self.base_clf.state_dict(), enc_state_dict_path)
-        torch.save(self.fc1.state_dict(), layer1_path)
-        torch.save(self.fc2.state_dict(), layer2_path)
-        torch.save(self.optim.state_dict(), optimizer_path)
+        save_checkpoint(os.path.join(save_path, CLASSIFIER_CHECKPOINT), self.checkpoint_modules())
+        torch_save_atomic(os.path.join(save_path, TRAINING_STATE), {"optim": self.optim.state_dict()})
 
 
 
@@ -361,9 +650,13 @@ class Clssifier(torch.nn.Module):
                     lr,
                     optimizer,
                     batch_size,
+                    eval_batch_size=None,
+                    eval_every=1,
                     **optimizer_hparms
                     ):
         assert optimizer.lower() in ["adagrad", "adam", "rmsprop"]
+        if eval_every < 1:
+            raise ValueError("The eval_every should be at least 1")
 
         if optimizer.lower() == "adagrad":
             eps = optimizer_hparms["eps"] if "eps" in optimizer_hparms.keys() else 1e-10
@@ -405,7 +698,7 @@ class Clssifier(torch.nn.Module):
             )
 
         train_dl = DataLoader(train_ds, batch_size=batch_size, shuffle=True)
-        val_dl = DataLoader(train_ds, batch_size=batch_size)
+        val_dl = eval_dataloader(val_ds, eval_batch_size or 2 * batch_size, num_workers=0)
 
         max_val_acc = -np.inf
         train_epoch_loss = []
@@ -413,12 +706,10 @@ class Clssifier(torch.nn.Module):
         train_epoch_acc = []
         val_epoch_acc = []
 
+        train_metrics = MetricsAccumulator(DEVICE, topk=(1,))
         for epoch in range(1, epochs + 1):
             self.train()
-            train_batch_losses = []
-            train_preds_match = []
-            val_batch_losses = []
-            val_preds_match = []
+            train_metrics.reset()
             no_of_batches = len(train_dl)
             batch_cnt = 0
             for batch_data, batch_label in train_dl:
@@ -433,24 +724,26 @@ class Clssifier(torch.nn.Module):
                 loss = self.criterion(batch_op, batch_label)
                 loss.backward()
                 self.optim.step()
-                train_batch_losses.append(loss.item())
-                train_preds_match += self.__match_preds(batch_op, batch_label)
-
-            self.eval()
-            with torch.no_grad():
-                for batch_data, batch_label in val_dl:
-                    batch_data = batch_data.to(DEVICE)
-                    batch_label = batch_label.to(DEVICE)
-                    batch_op = self.forward(batch_data)
-                    loss = self.criterion(batch_op, batch_label)
-                    val_batch_losses.append(loss.item())
-                    val_preds_match += self.__match_preds(batch_op, batch_label)
+                train_metrics.update(loss, batch_op, batch_label)
 
             # calculate epoch stats
-            train_e_loss = np.mean(train_batch_losses)
-            val_e_loss = np.mean(val_batch_losses)
-            train_e_acc = sum(train_preds_match) / len(train_preds_match)
-            val_e_acc = sum(val_preds_match) / len(val_preds_match)
+            train_stats = train_metrics.compute()
+            train_e_loss = train_stats["loss"]
+            train_e_acc = train_stats["top1"]
+            train_epoch_loss.append(train_e_loss)
+            train_epoch_acc.append(train_e_acc)
+            if epoch % eval_every != 0 and epoch != epochs:
+                # None for the skipped validations, the val lists stay aligned with the train lists by epoch
+                val_epoch_loss.append(None)
+                val_epoch_acc.append(None)
+                print(f"---------------- {epoch} ----------------")
+                print(f"Train Loss: {train_e_loss}\t Train_acc: {train_e_acc}")
+                print()
+                continue
+
+            val_stats = evaluate(self.forward, val_dl, DEVICE, modules=[self], criterion=self.criterion, topk=(1,))
+            val_e_loss = val_stats["loss"]
+            val_e_acc = val_stats["top1"]
 
             if val_e_acc > max_val_acc:
                 model_path = os.path.join(SAVE_DIR, "dlops_shit", f"epoch_{epoch}")
@@ -464,9 +757,7 @@ class Clssifier(torch.nn.Module):
             print(f"Val Loss: {val_e_loss}\t Val_acc: {val_e_acc}")
             print()
 
-            train_epoch_loss.append(train_e_loss)
             val_epoch_loss.append(val_e_loss)
-            train_epoch_acc.append(train_e_acc)
             val_epoch_acc.append(val_e_acc)
 
         return train_epoch_loss, val_epoch_loss, train_epoch_acc, val_epoch_acc
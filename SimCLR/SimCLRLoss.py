@@ -1,56 +1,119 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math
+from distributed import all_gather_with_grad, is_distributed, get_rank
 
 
 class NTXent(nn.Module):
-    def __init__(self, batch_size:int, temp):
+    def __init__(self, batch_size:int, temp, mode="matmul", chunk_size=1024):
         super(NTXent, self).__init__()
+        valid_modes = ["cosine", "matmul", "chunked"]
+        if mode not in valid_modes:
+            raise ValueError(f"The mode should be in {valid_modes}")
         self.batch_size = batch_size
         self.temp = temp
+        self.mode = mode
+        self.chunk_size = chunk_size
         self.criterion = nn.CrossEntropyLoss()
+        self._mask_cache = {}
 
-    def mask_diagonal(self):
-        n = 2 * self.batch_size
-        mask_d = torch.ones((n, n), dtype=bool)
-        for i in range(n):
-            mask_d[i, i] = 0
-        return mask_d
-
-    def mask_pos(self):
-        n = 2 * self.batch_size
-        org_st = 0
-        aug_st = self.batch_size
-        mask_aug = torch.zeros((n, n), dtype=bool)
-        i = 0
-        while i < n/2:
-            mask_aug[org_st, aug_st] = 1
-            mask_aug[aug_st, org_st] = 1
-            org_st += 1
-            aug_st += 1
-            i += 1
+    def mask_diagonal(self, batch_size=None, device=None):
+        n = 2 * (batch_size or self.batch_size)
+        return ~torch.eye(n, dtype=torch.bool, device=device)
+
+    def mask_pos(self, batch_size=None, device=None):
+        n = 2 * (batch_size or self.batch_size)
+        mask_aug = torch.zeros((n, n), dtype=torch.bool, device=device)
+        idx = torch.arange(n, device=device)
+        mask_aug[idx, self.positive_index(n // 2, device)] = True
         return mask_aug
 
+    @staticmethod
+    def positive_index(batch_size, device=None):
+        # row i of the original view is paired with row i of the augmented view and vice versa
+        idx = torch.arange(2 * batch_size, device=device)
+        return (idx + batch_size) % (2 * batch_size)
+
+    def _masks(self, batch_size, device):
+        key = (batch_size, device)
+        if key not in self._mask_cache:
+            self._mask_cache[key] = (~self.mask_diagonal(batch_size, device),
+                                     self.positive_index(batch_size, device))
+        return self._mask_cache[key]
+
+    def _block_loss(self, z_block, z, start, labels):
+        # summed loss of the rows [start, start + len(z_block)), only a block x 2N slice of logits exists
+        rows = torch.arange(z_block.shape[0], device=z.device)
+        logits = z_block @ z.T / self.temp
+        logits[rows, rows + start] = float("-inf")
+        pos = logits[rows, labels[start:start + z_block.shape[0]]]
+        return (torch.logsumexp(logits, dim=1) - pos).sum()
+
+    def _distributed_loss(self, z_org, z_aug):
+        # negatives come from the global batch of every rank, but each rank only computes the rows of its
+        # own samples. The loss is their mean, which after DistributedDataParallel's gradient averaging
+        # gives the gradient of the global loss, since GatherLayer sums the gathered gradients back
+        n = z_org.shape[0]
+        z_org = all_gather_with_grad(z_org)
+        z_aug = all_gather_with_grad(z_aug)
+        global_batch_size = z_org.shape[0]
+        z = F.normalize(torch.cat((z_org, z_aug), dim=0), dim=1)
+        labels = self.positive_index(global_batch_size, z.device)
+        block_size = self.chunk_size if self.mode == "chunked" else n
+        loss = 0
+        for rows_start in (get_rank() * n, global_batch_size + get_rank() * n):
+            for start in range(rows_start, rows_start + n, block_size):
+                z_block = z[start:min(start + block_size, rows_start + n)]
+                if self.mode == "chunked":
+                    loss = loss + checkpoint(self._block_loss, z_block, z, start, labels, use_reentrant=False)
+                else:
+                    loss = loss + self._block_loss(z_block, z, start, labels)
+        return loss / (2 * n)
+
     def forward(self, z_org, z_aug):
-        # print(z_org.shape)
-        # print(z_aug.shape)
-        # print(self.batch_size)
-        n = 2 * self.batch_size
-        mask_d = self.mask_diagonal()
-        mask_pos = self.mask_pos()
-        mask_neg = torch.ones((n, n), dtype=bool)
-        mask_neg = torch.logical_and(mask_neg, torch.logical_not(mask_d))
-        mask_neg = torch.logical_not(torch.logical_or(mask_neg, mask_pos))
+        if is_distributed():
+            return self._distributed_loss(z_org, z_aug)
+        # the last batch of an epoch can be smaller than self.batch_size
+        batch_size = z_org.shape[0]
+        self_mask, labels = self._masks(batch_size, z_org.device)
         z = torch.cat((z_org, z_aug), dim=0)
-        # print(z.shape)
-        sim_mat = torch.cosine_similarity(z.unsqueeze(1), z.unsqueeze(0), dim=2)
-        sim_mat /= self.temp
-        # print(sim_mat.shape)
-        negative_samples = sim_mat[mask_neg].reshape(n, -1)
-        positive_samples = sim_mat[mask_pos].reshape(n, -1)
-        logits = torch.cat((negative_samples, positive_samples), dim=1)
-        # print(logits.shape)
-        labels = torch.full((n,), n-2).to(positive_samples.device)
+
+        if self.mode == "chunked":
+            z = F.normalize(z, dim=1)
+            # recomputing each block in backward keeps peak memory at chunk_size x 2N
+            loss = 0
+            for start in range(0, z.shape[0], self.chunk_size):
+                loss = loss + checkpoint(self._block_loss, z[start:start + self.chunk_size], z, start, labels,
+                                         use_reentrant=False)
+            return loss / z.shape[0]
+
+        if self.mode == "matmul":
+            z = F.normalize(z, dim=1)
+            sim_mat = z @ z.T
+        else:
+            sim_mat = torch.cosine_similarity(z.unsqueeze(1), z.unsqueeze(0), dim=2)
+        sim_mat = sim_mat / self.temp
+        # dropping the self-similarity leaves the positive and the 2N-2 negatives per row
+        logits = sim_mat.masked_fill(self_mask, float("-inf"))
         loss = self.criterion(logits, labels)
         return loss
 
+
+if __name__ == "__main__":
+    # the matmul and chunked modes should reproduce the original cosine loss and its gradients
+    torch.manual_seed(0)
+    for batch_size in (16, 33):
+        z_org = torch.randn(batch_size, 128, dtype=torch.float64)
+        z_aug = torch.randn(batch_size, 128, dtype=torch.float64)
+        results = {}
+        for mode in ["cosine", "matmul", "chunked"]:
+            z_o = z_org.clone().requires_grad_()
+            z_a = z_aug.clone().requires_grad_()
+            loss = NTXent(batch_size, 0.5, mode=mode, chunk_size=10)(z_o, z_a)
+            loss.backward()
+            results[mode] = (loss.detach(), z_o.grad, z_a.grad)
+        for mode in ["matmul", "chunked"]:
+            ok = all(torch.allclose(a, b, atol=1e-10) for a, b in zip(results["cosine"], results[mode]))
+            print(f"batch {batch_size} {mode}: loss = {results[mode][0].item():.6f} matches cosine = {ok}")
@@ -1,10 +1,12 @@
 import os
+import random
 
 import numpy as np
 import torch
 from torchvision import transforms
-from torchvision.datasets import CIFAR10, CIFAR100
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from batch_augment import BatchAugment
+from data_store import CIFARStore, to_uint8_tensor
 
 
 # DATA_ROOT_PATH = r"F:\MTech_IIT_Jodhpur\3rd_Sem\DL-Ops\Project\DLOps_Project\DataPrep\datasets"
@@ -12,51 +14,118 @@ DATA_ROOT_PATH = './DataPrep/dataset'
 os.makedirs(DATA_ROOT_PATH, exist_ok=True)
 
 
+def simclr_transforms(size, s=1.0):
+    color_jitter = transforms.ColorJitter(0.8 * s, 0.8 * s, 0.8 * s, 0.2 * s)
+    gaussianblur = transforms.GaussianBlur(kernel_size=int(0.1 * size), sigma=(0.1, 2.0))
+
+    return transforms.Compose([
+        transforms.Lambda(to_uint8_tensor),
+        transforms.RandomResizedCrop(size=size),
+        transforms.RandomApply([color_jitter], p=0.8),
+        transforms.RandomApply([gaussianblur], p=0.5)
+    ])
+
+
+AUGMENTS = ["torchvision", "batched"]
+
+
 class SimCLRDataset(Dataset):
-    def __init__(self, dataset_name, batch_size):
+    def __init__(self, dataset_name, batch_size, augment="torchvision"):
         self.batch_size = batch_size
         valid_models = ["cifar10", "cifar100"]
         if dataset_name.lower() not in valid_models:
             raise ValueError(f"The data should be in {valid_models}")
+        if augment not in AUGMENTS:
+            raise ValueError(f"The augment should be in {AUGMENTS}")
+        self.augment = augment
 
-        data_src = CIFAR10 if dataset_name.lower() == "cifar10" else CIFAR100
+        # train and test images of the memory-mapped store, shared by all workers
+        self.store = CIFARStore(dataset_name, DATA_ROOT_PATH)
 
-        c_train = data_src(DATA_ROOT_PATH, download=True, train=True)
-        c_test = data_src(DATA_ROOT_PATH, download=True, train=False)
-        self.all_img_np = np.concatenate((c_train.data, c_test.data))
-
-        s = 1.0
         size = self.all_img_np.shape[1]
-        color_jitter = transforms.ColorJitter(0.8 * s, 0.8 * s, 0.8 * s, 0.2 * s)
-        gaussianblur = transforms.GaussianBlur(kernel_size=int(0.1 * size), sigma=(0.1, 2.0))
-
-        self.data_transforms = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.RandomResizedCrop(size=size),
-            transforms.RandomApply([color_jitter], p=0.8),
-            transforms.RandomApply([gaussianblur], p=0.5)
-        ])
+        self.data_transforms = simclr_transforms(size)
+        self.batch_augment = BatchAugment(size)
 
         self.no_transforms = transforms.Compose([
-            transforms.ToTensor()
+            transforms.Lambda(to_uint8_tensor)
         ])
 
+    @property
+    def all_img_np(self):
+        return self.store.images
+
     def __len__(self):
-        return len(self.all_img_np) // self.batch_size
+        return len(self.all_img_np)
 
     def __getitem__(self, idx_):
-        idxs = list(np.random.choice(len(self.all_img_np), self.batch_size, replace=False))
+        # idx_ is a list of image indices coming from EpochBatchSampler, or a single index
+        if np.ndim(idx_) == 0:
+            original_tensors, aug_tensors = self[[idx_]]
+            return original_tensors[0], aug_tensors[0]
+
+        # one gather out of the memory map for the whole batch
+        imgs = self.all_img_np[np.asarray(idx_)]
+        # batches leave the workers as uint8, the encoder converts and normalizes them on the device
+        if self.augment == "batched":
+            aug_tensors = self.batch_augment(imgs).mul_(255).round_().to(torch.uint8)
+            return to_uint8_tensor(imgs), aug_tensors
+
         original_tensors = []
         aug_tensors = []
-        for idx in idxs:
-            aug_tensors.append(self.data_transforms(self.all_img_np[idx]))
-            original_tensors.append(self.no_transforms(self.all_img_np[idx]))
+        for img in imgs:
+            aug_tensors.append(self.data_transforms(img))
+            original_tensors.append(self.no_transforms(img))
         return torch.stack(original_tensors), torch.stack(aug_tensors)
 
 
+class EpochBatchSampler(Sampler):
+    # yields lists of indices from one fresh permutation per epoch, seeded by (seed, epoch).
+    # With world_size > 1 every rank draws the same permutation and takes every world_size-th index,
+    # the few samples left over by an uneven split are dropped so all ranks run the same number of batches
+    def __init__(self, data_len, batch_size, seed=0, drop_last=False, rank=0, world_size=1):
+        self.data_len = data_len
+        self.batch_size = batch_size
+        self.seed = seed
+        self.drop_last = drop_last
+        self.rank = rank
+        self.world_size = world_size
+        self.shard_len = data_len // world_size
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        # start_batch skips the batches a resumed run already trained on, the permutation stays the same
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.shard_len // self.batch_size
+        return (self.shard_len + self.batch_size - 1) // self.batch_size
+
+    def epoch_indices(self):
+        # this rank's share of the epoch's permutation, batch b is epoch_indices()[b * batch_size:(b + 1) * batch_size]
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        perm = torch.randperm(self.data_len, generator=g)[:self.shard_len * self.world_size]
+        return perm[self.rank::self.world_size]
+
+    def __iter__(self):
+        perm = self.epoch_indices()
+        for batch_no in range(self.start_batch, len(self)):
+            yield perm[batch_no * self.batch_size:(batch_no + 1) * self.batch_size].tolist()
+
+
+def seed_worker(worker_id):
+    # the DataLoader already gives every worker its own torch seed, derive numpy and random from it
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
 if __name__ == "__main__":
     cif10ds = SimCLRDataset("CIFAR10", batch_size=16)
-    print(len(cif10ds))
+    print(len(cif10ds), len(EpochBatchSampler(len(cif10ds), 16)))
 
     cif100ds = SimCLRDataset("CIFAR100", batch_size=16)
-    print(len(cif100ds))
+    print(len(cif100ds), len(EpochBatchSampler(len(cif100ds), 16)))
@@ -12,6 +12,7 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 def main():
     st.title("Image Prediction System ")
+    predictor = get_predictor()
 
     menu = ["Image Prediction", "About"]
     choice = st.sidebar.selectbox("Menu", menu)
@@ -27,7 +28,7 @@ def main():
                 arr = []
 
                 image = load_image(image_file)
-                pred = image_prediction(image)
+                pred = predictor.predict(image)
                 for key in pred:
                     arr.append(np.array([key, get_image_class(int(pred.get(key)))]))
                 arr = np.array(arr)
@@ -35,6 +36,9 @@ def main():
                 col_values = ['Probability in %', 'Class']
                 df = pd.DataFrame(data=arr, index=index_values, columns=col_values)
                 st.table(df)
+                stats = predictor.stats()
+                st.caption(f"model load: {stats['load_time_s']:.2f}s, "
+                           f"prediction: {stats['last_latency_ms']:.1f}ms")
                 #st.write(pred)
     else:
         st.subheader("About")
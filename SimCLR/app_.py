@@ -5,8 +5,9 @@ import os
 
 from flask import Flask, jsonify, request, render_template
 from predict_image import *
+from micro_batch import MicroBatcher, MAX_BATCH_SIZE, MAX_WAIT_MS
+from retrieval import get_retriever
 import numpy as np
-import cv2
 
 must_reload_page = False
 
@@ -20,6 +21,10 @@ def start_flask():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     app = Flask(__name__)
+    # flask answers 413 for larger request bodies before they are read
+    app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+    predictor = get_predictor()
+    batcher = MicroBatcher(predictor, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS)
 
     @app.route('/')
     def home():
@@ -34,14 +39,32 @@ def start_flask():
                 return jsonify(pred)'''
 
         if request.data is not None:
-            npar = np.fromstring(request.data, np.uint8)
-            img = cv2.imdecode(npar, cv2.IMREAD_COLOR)
-            # path = os.path.join(os.path.join(os.getcwd(), '../webpages'), 'img.jpg')
-            # imge = cv2.imread(path)
-            image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            pred = image_prediction(image)
+            try:
+                image = decode_image(request.data, max_bytes=MAX_UPLOAD_BYTES)
+            except (OSError, ValueError) as e:
+                return jsonify({"error": str(e)}), 400
+            pred = batcher.predict(image)
             return jsonify(pred)
 
+    @app.route('/similar', methods=['POST'])
+    def similar():
+        # the catalog images closest to the posted image in the SimCLR embedding space
+        if request.data is not None:
+            try:
+                image = decode_image(request.data, max_bytes=MAX_UPLOAD_BYTES)
+            except (OSError, ValueError) as e:
+                return jsonify({"error": str(e)}), 400
+            k = request.args.get('k', default=None, type=int)
+            try:
+                retriever = get_retriever()
+            except FileNotFoundError:
+                return jsonify({"error": "no retrieval index yet, build one with python retrieval.py <image_dir>"}), 503
+            return jsonify(retriever.query([image], k)[0])
+
+    @app.route('/stats', methods=['GET'])
+    def stats():
+        return jsonify(predictor.stats())
+
     @app.route('/dummy', methods=['GET', 'POST'])
     def dummy():
         if request.data is not None:
@@ -0,0 +1,15 @@
+import os
+
+
+def atomic_write(path, write_fn):
+    # write_fn(tmp_path) fills a temporary file that then replaces path in one rename, readers never see
+    # a partial file and an interrupted write leaves the previous one intact. The pid in the temporary
+    # name keeps processes writing the same path at once (DDP ranks) from renaming each other's file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
@@ -0,0 +1,127 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _grayscale(x):
+    return (0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+def _rgb2hsv(x):
+    r, g, b = x.unbind(dim=1)
+    maxc = x.max(dim=1).values
+    minc = x.min(dim=1).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return h, s, maxc
+
+
+def _hsv2rgb(h, s, v):
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(torch.int64) % 6
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+    # pick (r, g, b) out of the six hue sectors
+    sectors = torch.stack((torch.stack((v, q, p, p, t, v), dim=1),
+                           torch.stack((t, v, v, q, p, p), dim=1),
+                           torch.stack((p, p, t, v, v, q), dim=1)), dim=1)
+    return sectors.gather(2, i[:, None, None].expand(-1, 3, 1, -1, -1)).squeeze(2)
+
+
+def _uniform(n, low, high, device):
+    return torch.empty(n, device=device).uniform_(low, high)
+
+
+class BatchAugment:
+    # the SimCLRDataset augmentations applied to a whole uint8 NHWC batch at once,
+    # each sample still draws its own crop, jitter factors and blur sigma
+    def __init__(self, size, s=1.0, scale=(0.08, 1.0), ratio=(3 / 4, 4 / 3),
+                 jitter_p=0.8, blur_p=0.5, blur_sigma=(0.1, 2.0), device="cpu"):
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.brightness = (max(0.0, 1 - 0.8 * s), 1 + 0.8 * s)
+        self.contrast = (max(0.0, 1 - 0.8 * s), 1 + 0.8 * s)
+        self.saturation = (max(0.0, 1 - 0.8 * s), 1 + 0.8 * s)
+        self.hue = (-0.2 * s, 0.2 * s)
+        self.jitter_p = jitter_p
+        self.blur_p = blur_p
+        self.blur_kernel = int(0.1 * size)
+        self.blur_sigma = blur_sigma
+        self.device = torch.device(device)
+
+    def __call__(self, imgs):
+        if isinstance(imgs, np.ndarray):
+            imgs = torch.from_numpy(np.ascontiguousarray(imgs))
+        x = imgs.to(self.device).permute(0, 3, 1, 2).float().div_(255)
+        x = self.resized_crop(x)
+        x = self.color_jitter(x)
+        x = self.gaussian_blur(x)
+        return x
+
+    def resized_crop(self, x):
+        n = x.shape[0]
+        area = _uniform(n, *self.scale, x.device)
+        log_ratio = _uniform(n, *self.log_ratio, x.device)
+        # crop width/height as a fraction of the image, clamped instead of torchvision's rejection sampling
+        w = torch.sqrt(area * torch.exp(log_ratio)).clamp(max=1.0)
+        h = torch.sqrt(area / torch.exp(log_ratio)).clamp(max=1.0)
+        cx = (1 - w) * (2 * torch.rand(n, device=x.device) - 1)
+        cy = (1 - h) * (2 * torch.rand(n, device=x.device) - 1)
+        theta = torch.zeros(n, 2, 3, device=x.device)
+        theta[:, 0, 0] = w
+        theta[:, 0, 2] = cx
+        theta[:, 1, 1] = h
+        theta[:, 1, 2] = cy
+        grid = F.affine_grid(theta, [n, x.shape[1], self.size, self.size], align_corners=False)
+        return F.grid_sample(x, grid, mode="bilinear", padding_mode="border", align_corners=False)
+
+    def color_jitter(self, x):
+        n = x.shape[0]
+        b = _uniform(n, *self.brightness, x.device)[:, None, None, None]
+        c = _uniform(n, *self.contrast, x.device)[:, None, None, None]
+        s = _uniform(n, *self.saturation, x.device)[:, None, None, None]
+        hue = _uniform(n, *self.hue, x.device)[:, None, None]
+
+        y = (x * b).clamp(0, 1)
+        mean = _grayscale(y).mean(dim=(1, 2, 3), keepdim=True)
+        y = (c * y + (1 - c) * mean).clamp(0, 1)
+        y = (s * y + (1 - s) * _grayscale(y)).clamp(0, 1)
+        h, sat, v = _rgb2hsv(y)
+        y = _hsv2rgb(torch.remainder(h + hue, 1.0), sat, v)
+
+        apply = torch.rand(n, device=x.device) < self.jitter_p
+        return torch.where(apply[:, None, None, None], y, x)
+
+    def gaussian_blur(self, x):
+        n, c, height, width = x.shape
+        k = self.blur_kernel
+        if k < 3:
+            return x
+        sigma = _uniform(n, *self.blur_sigma, x.device)
+        offsets = torch.arange(k, device=x.device) - (k - 1) / 2
+        kernel = torch.exp(-offsets[None] ** 2 / (2 * sigma[:, None] ** 2))
+        kernel = (kernel / kernel.sum(dim=1, keepdim=True)).repeat_interleave(c, dim=0)
+
+        # one depthwise, separable convolution over all samples and channels
+        y = F.pad(x.reshape(1, n * c, height, width), [k // 2] * 4, mode="reflect")
+        y = F.conv2d(y, kernel[:, None, None, :], groups=n * c)
+        y = F.conv2d(y, kernel[:, None, :, None], groups=n * c)
+        y = y.reshape(n, c, height, width)
+
+        apply = torch.rand(n, device=x.device) < self.blur_p
+        return torch.where(apply[:, None, None, None], y, x)
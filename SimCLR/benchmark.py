@@ -0,0 +1,423 @@
+import io
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def _timed(fn, *args):
+    st = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - st
+
+
+def _report(name, latencies, wall_time):
+    latencies = np.asarray(latencies) * 1000
+    print(f"{name:<28} p50 = {np.percentile(latencies, 50):8.2f}ms  "
+          f"p99 = {np.percentile(latencies, 99):8.2f}ms  "
+          f"throughput = {len(latencies) / wall_time:8.1f} req/s")
+
+
+def bench_serving(concurrency_levels=(1, 4, 16, 64), n_requests=256, max_batch_size=32, max_wait_ms=5,
+                  sizes=((32, 32), (480, 640), (640, 480), (720, 1280), (1080, 1920))):
+    from PIL import Image
+    from SimCLR import Clssifier
+    from predict_image import Predictor
+    from micro_batch import MicroBatcher
+
+    predictor = Predictor(model=Clssifier(100, 0, pretrained=False))
+    # uploads of mixed aspect ratios, decoded the way decode_image hands them to the predictor
+    shapes = [sizes[i % len(sizes)] for i in range(n_requests)]
+    images = [Image.fromarray(np.random.randint(0, 256, (h, w, 3), dtype=np.uint8)) for h, w in shapes]
+    batcher = MicroBatcher(predictor, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    for concurrency in concurrency_levels:
+        print(f"---- concurrency {concurrency} ----")
+        for name, fn in [("per-request", predictor.predict), ("micro-batched", batcher.predict)]:
+            n_batches = batcher.n_batches
+            with ThreadPoolExecutor(concurrency) as pool:
+                st = time.perf_counter()
+                latencies = list(pool.map(lambda img: _timed(fn, img), images))
+                wall_time = time.perf_counter() - st
+            _report(name, latencies, wall_time)
+            if fn == batcher.predict:
+                print(f"{'':<28} mean batch = {n_requests / (batcher.n_batches - n_batches):6.1f} requests")
+    batcher.close()
+
+
+def ntxent_reference(z_org, z_aug, temp):
+    # the original loop-and-gather NT-Xent, kept as the baseline for the benchmarks
+    batch_size = z_org.shape[0]
+    n = 2 * batch_size
+    mask_d = torch.ones((n, n), dtype=bool)
+    for i in range(n):
+        mask_d[i, i] = 0
+    mask_pos = torch.zeros((n, n), dtype=bool)
+    for i in range(batch_size):
+        mask_pos[i, batch_size + i] = 1
+        mask_pos[batch_size + i, i] = 1
+    mask_neg = torch.logical_not(torch.logical_or(torch.logical_not(mask_d), mask_pos))
+    z = torch.cat((z_org, z_aug), dim=0)
+    sim_mat = torch.cosine_similarity(z.unsqueeze(1), z.unsqueeze(0), dim=2) / temp
+    negative_samples = sim_mat[mask_neg.to(z.device)].reshape(n, -1)
+    positive_samples = sim_mat[mask_pos.to(z.device)].reshape(n, -1)
+    logits = torch.cat((negative_samples, positive_samples), dim=1)
+    labels = torch.full((n,), n - 2, device=z.device)
+    return torch.nn.functional.cross_entropy(logits, labels)
+
+
+def _time_loss(loss_fn, z_org, z_aug, repeats):
+    times = []
+    for _ in range(repeats):
+        z_o = z_org.detach().requires_grad_()
+        z_a = z_aug.detach().requires_grad_()
+        st = time.perf_counter()
+        loss = loss_fn(z_o, z_a)
+        loss.backward()
+        if z_o.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - st)
+    return np.median(times) * 1000
+
+
+def _child_peak_mb(fn, args):
+    import SimCLR
+    from perf import rss_peak_mb
+    before = rss_peak_mb()
+    fn(*args)
+    return rss_peak_mb() - before
+
+
+def _peak_memory_mb(fn, *args):
+    # peak allocator memory on cuda, otherwise the rss growth of a fresh process running fn
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        fn(*args)
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(_child_peak_mb, fn, args).result()
+
+
+def _ntxent_step(mode, batch_size, dim, chunk_size, temp=0.5):
+    from SimCLRLoss import NTXent
+    from SimCLR import DEVICE
+
+    z_org = torch.randn(batch_size, dim, device=DEVICE, requires_grad=True)
+    z_aug = torch.randn(batch_size, dim, device=DEVICE, requires_grad=True)
+    if mode == "reference":
+        loss = ntxent_reference(z_org, z_aug, temp)
+    else:
+        loss = NTXent(batch_size, temp, mode=mode, chunk_size=chunk_size)(z_org, z_aug)
+    loss.backward()
+
+
+def bench_ntxent(batch_sizes=(64, 256, 512, 2048), dim=128, temp=0.5, repeats=5, chunk_size=256,
+                 broadcast_limit=512):
+    from SimCLRLoss import NTXent
+    from SimCLR import DEVICE
+
+    # reference and cosine materialize a (2N, 2N, dim) intermediate and are skipped above broadcast_limit
+    for batch_size in batch_sizes:
+        z_org = torch.randn(batch_size, dim, device=DEVICE)
+        z_aug = torch.randn(batch_size, dim, device=DEVICE)
+        print(f"---- batch {batch_size} ----")
+        for mode in ["reference", "cosine", "matmul", "chunked"]:
+            if mode in ["reference", "cosine"] and batch_size > broadcast_limit:
+                continue
+            if mode == "reference":
+                loss_fn = lambda a, b: ntxent_reference(a, b, temp)
+            else:
+                loss_fn = NTXent(batch_size, temp, mode=mode, chunk_size=chunk_size)
+            step_ms = _time_loss(loss_fn, z_org, z_aug, repeats)
+            peak_mb = _peak_memory_mb(_ntxent_step, mode, batch_size, dim, chunk_size, temp)
+            print(f"{mode:<10} step = {step_ms:9.2f}ms  peak memory = {peak_mb:9.1f}MB")
+
+
+def bench_augment(batch_size=512, size=32, repeats=3):
+    from SimCLR_Data import simclr_transforms
+    from batch_augment import BatchAugment
+
+    imgs = np.random.randint(0, 256, (batch_size, size, size, 3), dtype=np.uint8)
+    data_transforms = simclr_transforms(size)
+    batch_augment = BatchAugment(size)
+    paths = {
+        "torchvision per-image": lambda: torch.stack([data_transforms(img) for img in imgs]),
+        "batched": lambda: batch_augment(imgs),
+    }
+    for name, fn in paths.items():
+        elapsed = min(_timed(fn) for _ in range(repeats))
+        print(f"{name:<24} {batch_size / elapsed:10.1f} images/sec")
+
+
+def _pretext_steps(precision, channels_last, batch_size, steps, encoder_arch="imagenet"):
+    from SimCLR import Classifier, DEVICE
+    from SimCLRLoss import NTXent
+    from perf import autocast_dtype, grad_scaler
+
+    clf = Classifier(100, -1, encoder_arch=encoder_arch)
+    model = clf.feature_extractor
+    if channels_last:
+        model.base_enc.to_channels_last()
+    params = list(model.base_enc.model.parameters()) + list(model.projection_head.parameters())
+    optim = torch.optim.Adam(params, lr=1e-4)
+    amp_dtype = autocast_dtype(precision, DEVICE)
+    scaler = grad_scaler(DEVICE, amp_dtype)
+    criterion = NTXent(batch_size, 0.5)
+    original = torch.rand(batch_size, 3, 32, 32)
+    aug = torch.rand(batch_size, 3, 32, 32)
+
+    clf.pretext_step(criterion, optim, scaler, amp_dtype, original, aug)
+    times = []
+    for _ in range(steps):
+        times.append(_timed(clf.pretext_step, criterion, optim, scaler, amp_dtype, original, aug))
+        if DEVICE.type == "cuda":
+            torch.cuda.synchronize()
+    return np.median(times) * 1000
+
+
+def _two_pass_step(clf, criterion, optim, scaler, amp_dtype, original, aug):
+    # the pre-fusion pretext step, one forward pass per view
+    from SimCLR import DEVICE
+    from perf import autocast
+
+    model = clf.feature_extractor
+    optim.zero_grad()
+    with autocast(DEVICE, amp_dtype):
+        loss = criterion(model(original), model(aug))
+    scaler.scale(loss).backward()
+    scaler.step(optim)
+    scaler.update()
+    return loss
+
+
+def bench_fused_step(batch_size=32, steps=3, encoder_arch="cifar"):
+    from SimCLR import Classifier, DEVICE
+    from SimCLRLoss import NTXent
+    from perf import grad_scaler
+
+    clf = Classifier(100, -1, encoder_arch=encoder_arch)
+    model = clf.feature_extractor
+    params = list(model.base_enc.model.parameters()) + list(model.projection_head.parameters())
+    optim = torch.optim.Adam(params, lr=1e-4)
+    scaler = grad_scaler(DEVICE, None)
+    criterion = NTXent(batch_size, 0.5)
+    original = torch.randint(0, 256, (batch_size, 3, 32, 32), dtype=torch.uint8)
+    aug = torch.randint(0, 256, (batch_size, 3, 32, 32), dtype=torch.uint8)
+
+    steps_fns = {
+        "two forward passes": lambda: _two_pass_step(clf, criterion, optim, scaler, None, original, aug),
+        "fused 2N forward": lambda: clf.pretext_step(criterion, optim, scaler, None, original, aug),
+    }
+    for name, fn in steps_fns.items():
+        fn()
+        times = []
+        for _ in range(steps):
+            times.append(_timed(fn))
+            if DEVICE.type == "cuda":
+                torch.cuda.synchronize()
+        print(f"{name:<20} step = {np.median(times) * 1000:9.1f}ms")
+
+
+def bench_precision(batch_size=32, steps=3):
+    from SimCLR import DEVICE
+
+    modes = [("fp32", False), ("fp32", True), ("bf16", False), ("bf16", True)]
+    if DEVICE.type == "cuda":
+        modes += [("fp16", False), ("fp16", True)]
+    for precision, channels_last in modes:
+        step_ms = _pretext_steps(precision, channels_last, batch_size, steps)
+        peak_mb = _peak_memory_mb(_pretext_steps, precision, channels_last, batch_size, 1)
+        print(f"{precision} channels_last={channels_last!s:<5} step = {step_ms:9.1f}ms  "
+              f"peak memory = {peak_mb:9.1f}MB")
+
+
+def bench_encoder_arch(batch_size=32, steps=3):
+    from SimCLR import ENCODER_ARCHS
+
+    for encoder_arch in ENCODER_ARCHS:
+        step_ms = _pretext_steps("fp32", False, batch_size, steps, encoder_arch)
+        peak_mb = _peak_memory_mb(_pretext_steps, "fp32", False, batch_size, 1, encoder_arch)
+        print(f"{encoder_arch:<9} step = {step_ms:9.1f}ms  "
+              f"throughput = {2 * batch_size / step_ms * 1000:8.1f} images/sec  peak memory = {peak_mb:9.1f}MB")
+
+
+def _unfreeze_steps(n_blocks, mode, batch_size, steps, encoder_arch="cifar"):
+    from SimCLR import Classifier, DEVICE
+    from SimCLRLoss import NTXent
+    from perf import grad_scaler
+
+    clf = Classifier(100, n_blocks, encoder_arch=encoder_arch)
+    model = clf.feature_extractor
+    if mode == "requires_grad":
+        # the frozen parameters only, the prefix still runs under autograd with train-mode BatchNorm
+        model.base_enc.n_frozen = 0
+    params = list(model.projection_head.parameters()) + \
+        [param for param in model.base_enc.model.parameters() if param.requires_grad]
+    optim = torch.optim.Adam(params, lr=1e-4)
+    scaler = grad_scaler(DEVICE, None)
+    criterion = NTXent(batch_size, 0.5)
+    original = torch.randint(0, 256, (batch_size, 3, 32, 32), dtype=torch.uint8)
+    aug = torch.randint(0, 256, (batch_size, 3, 32, 32), dtype=torch.uint8)
+    batch_indices = None
+    if mode == "prefix cache":
+        model.base_enc.enable_prefix_cache(batch_size, 1024)
+        batch_indices = torch.arange(batch_size)
+
+    # the first step fills the prefix cache, the timed ones see the same images as a later epoch would
+    clf.pretext_step(criterion, optim, scaler, None, original, aug, batch_indices=batch_indices)
+    times = []
+    for _ in range(steps):
+        times.append(_timed(clf.pretext_step, criterion, optim, scaler, None, original, aug, None, None, None,
+                            batch_indices))
+        if DEVICE.type == "cuda":
+            torch.cuda.synchronize()
+    return np.median(times) * 1000
+
+
+def bench_unfreeze(batch_size=64, steps=3, encoder_arch="cifar"):
+    from SimCLR import RESNET_BLOCKS
+
+    for n_blocks in range(len(RESNET_BLOCKS) + 1):
+        print(f"---- {n_blocks} trainable blocks ----")
+        modes = ["requires_grad", "frozen prefix", "prefix cache"] if n_blocks < len(RESNET_BLOCKS) \
+            else ["requires_grad"]
+        for mode in modes:
+            step_ms = _unfreeze_steps(n_blocks, mode, batch_size, steps, encoder_arch)
+            peak_mb = _peak_memory_mb(_unfreeze_steps, n_blocks, mode, batch_size, 1, encoder_arch)
+            print(f"{mode:<14} step = {step_ms:9.1f}ms  peak memory = {peak_mb:9.1f}MB")
+
+
+def bench_export(batch_sizes=(1, 32), n_iters=30, encoder_arch="imagenet"):
+    from SimCLR import Clssifier
+    from checkpoint import save_checkpoint, CLASSIFIER_CHECKPOINT
+    from export_model import export_predictor, load_artifact
+
+    with tempfile.TemporaryDirectory() as save_path:
+        model = Clssifier(100, 0, pretrained=False, encoder_arch=encoder_arch)
+        save_checkpoint(f"{save_path}/{CLASSIFIER_CHECKPOINT}", model.checkpoint_modules())
+
+        # cold start: from the files on disk to a model ready for its first request
+        st = time.perf_counter()
+        eager = Clssifier(100, 0, pretrained=False, encoder_arch=encoder_arch)
+        eager.load_model(load_optim=False, save_path=save_path)
+        eager.eval()
+        eager_load = time.perf_counter() - st
+        export_predictor(encoder_arch=encoder_arch, save_path=save_path)
+        loaded = {}
+        for name, optimize in [("frozen", False), ("optimized", True)]:
+            st = time.perf_counter()
+            loaded[name] = load_artifact(save_path, optimize=optimize)
+            print(f"{name:<12} load = {(time.perf_counter() - st) * 1000:8.1f}ms")
+    print(f"{'eager':<12} load = {eager_load * 1000:8.1f}ms")
+
+    for batch_size in batch_sizes:
+        x = torch.rand(batch_size, 3, 32, 32)
+        with torch.inference_mode():
+            match = all(torch.allclose(eager(x), model(x), atol=1e-4) for model in loaded.values())
+            print(f"---- batch {batch_size}: outputs match = {match} ----")
+            for name, model in [("eager", eager), *loaded.items()]:
+                for _ in range(3):
+                    model(x)
+                latencies = [_timed(model, x) for _ in range(n_iters)]
+                _report(name, latencies, sum(latencies))
+
+
+def bench_retrieval(n_vectors=200000, dim=128, n_queries=256, k=10, n_lists=512, n_probes=(1, 4, 8, 16, 32)):
+    from retrieval import IVFIndex, brute_force_search
+
+    # clustered unit vectors, so the lists carry structure like real embeddings
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((1000, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, 1000, n_vectors)] + 0.5 * rng.standard_normal((n_vectors, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.choice(n_vectors, n_queries, replace=False)] + 0.1 * rng.standard_normal((n_queries, dim),
+                                                                                                  dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    index = IVFIndex(dim, n_lists)
+    build_time = _timed(index.train, vectors)
+    build_time += _timed(index.add, vectors)
+    print(f"{n_vectors} vectors, {n_lists} lists, built in {build_time:.2f}s")
+    exact_ids = brute_force_search(vectors, queries, k)[1]
+
+    def run(name, search):
+        batched = _timed(search, queries) / n_queries
+        single = [_timed(search, queries[i:i + 1]) for i in range(32)]
+        ids = search(queries)[1]
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(ids, exact_ids)])
+        print(f"{name:<16} batched = {batched * 1000:7.3f}ms/query  single p50 = {np.median(single) * 1000:7.2f}ms  "
+              f"recall@{k} = {recall:.3f}")
+
+    run("brute force", lambda q: brute_force_search(vectors, q, k))
+    for n_probe in n_probes:
+        run(f"ivf n_probe={n_probe}", lambda q: index.search(q, k, n_probe))
+
+
+def _large_jpeg(width, height, quality=90):
+    # smooth gradients plus noise, compresses about like a photo
+    from PIL import Image
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=2)
+    pixels += np.random.default_rng(0).normal(0, 12, pixels.shape).astype(np.float32)
+    buf = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def _cv2_full_decode(data):
+    # the previous /prediction ingest: full resolution decode, then float conversion before the resize
+    import cv2
+    from torchvision import transforms
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    image = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return transforms.Resize(32)(transforms.ToTensor()(image))
+
+
+def _reduced_decode(data):
+    from predict_image import decode_image, transform
+    return transform(decode_image(data))
+
+
+def _decode_many(fn, data, n):
+    for _ in range(n):
+        fn(data)
+
+
+def bench_decode(sizes=((1920, 1080), (4032, 3024), (8000, 6000)), repeats=5):
+    paths = {"cv2 full + float resize": _cv2_full_decode, "draft + uint8 resize": _reduced_decode}
+    for width, height in sizes:
+        data = _large_jpeg(width, height)
+        print(f"---- {width}x{height} jpeg, {len(data) / 2 ** 20:.1f}MB ----")
+        for name, fn in paths.items():
+            fn(data)
+            elapsed = min(_timed(fn, data) for _ in range(repeats))
+            peak_mb = _peak_memory_mb(_decode_many, fn, data, 2)
+            print(f"{name:<24} decode = {elapsed * 1000:8.1f}ms  peak memory = {peak_mb:8.1f}MB")
+
+
+BENCHMARKS = {
+    "serving": bench_serving,
+    "ntxent": bench_ntxent,
+    "augment": bench_augment,
+    "precision": bench_precision,
+    "encoder_arch": bench_encoder_arch,
+    "fused_step": bench_fused_step,
+    "export": bench_export,
+    "retrieval": bench_retrieval,
+    "unfreeze": bench_unfreeze,
+    "decode": bench_decode,
+}
+
+
+if __name__ == "__main__":
+    torch.manual_seed(0)
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"======== {name} ========")
+        BENCHMARKS[name]()
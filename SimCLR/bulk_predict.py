@@ -0,0 +1,238 @@
+import argparse
+import csv
+import importlib.util
+import json
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from SimCLR import ENCODER_ARCHS
+from mapping import get_image_class
+from predict_image import Predictor, decode_image
+from retrieval import list_images, IMAGE_EXTENSIONS
+from atomic_io import atomic_write
+
+OUTPUT_FORMATS = ["csv", "jsonl", "parquet"]
+PARQUET_ENGINES = ["pyarrow", "fastparquet"]
+
+
+def iter_inputs(source, skip=0):
+    # (name, path or encoded bytes) in a fixed order, resuming skips the first `skip` of them
+    if os.path.isdir(source):
+        yield from ((path, path) for path in list_images(source)[skip:])
+    elif tarfile.is_tarfile(source):
+        # the tar is streamed once, member data is read here and decoded by the pool
+        with tarfile.open(source, "r|*") as tar:
+            n_seen = 0
+            for member in tar:
+                if not (member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS)):
+                    continue
+                n_seen += 1
+                if n_seen > skip:
+                    yield member.name, tar.extractfile(member).read()
+    else:
+        # a text file with one image path per line
+        with open(source) as f:
+            paths = (line.strip() for line in f)
+            n_seen = 0
+            for path in paths:
+                if not path:
+                    continue
+                n_seen += 1
+                if n_seen > skip:
+                    yield path, path
+
+
+def decode(item, preprocess):
+    # runs in the decode pool, a file that fails to decode becomes a row with an error instead of a crash
+    st = time.perf_counter()
+    name, data = item
+    tensor, error = None, None
+    try:
+        tensor = preprocess(decode_image(data))
+    except (OSError, ValueError) as e:
+        error = f"{type(e).__name__}: {e}"
+    return name, tensor, error, time.perf_counter() - st
+
+
+class LineWriter:
+    # csv and jsonl rows appended to one file. The byte offset after every committed batch goes into
+    # the progress file, a resumed run cuts off whatever was written after it
+    def __init__(self, path, fmt, top_k, offset=0):
+        self.fmt = fmt
+        self.top_k = top_k
+        with open(path, "a+b") as f:
+            f.truncate(offset)
+        self.f = open(path, "a", newline="")
+        self.csv = csv.writer(self.f) if fmt == "csv" else None
+        if self.csv is not None and offset == 0:
+            self.csv.writerow(["path", "error"] + [f"top{i}_{col}" for i in range(1, self.top_k + 1)
+                                                   for col in ["id", "prob", "name"]])
+
+    def write(self, rows):
+        for row in rows:
+            if self.csv is not None:
+                cells = [row["path"], row["error"] or ""]
+                for i in range(self.top_k):
+                    cells += [row["ids"][i], f"{row['probs'][i]:.6f}", row["names"][i]] if row["ids"] else ["", "", ""]
+                self.csv.writerow(cells)
+            else:
+                self.f.write(json.dumps(row) + "\n")
+        self.f.flush()
+        return {"offset": self.f.tell()}
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    # one parquet part per committed batch in the output directory, parts are renamed into place when complete
+    def __init__(self, path, top_k, parts=0):
+        self.path = path
+        self.top_k = top_k
+        self.parts = parts
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.startswith("part-") and int(name[5:11]) >= parts:
+                os.remove(os.path.join(path, name))
+
+    def write(self, rows):
+        # explicit nullable dtypes, a part without failed images would otherwise store the all-None columns as
+        # null and no longer share a schema with the other parts
+        table = pd.DataFrame({"path": pd.array([row["path"] for row in rows], "string"),
+                              "error": pd.array([row["error"] for row in rows], "string")})
+        for i in range(self.top_k):
+            table[f"top{i + 1}_id"] = pd.array([row["ids"][i] if row["ids"] else None for row in rows], "Int64")
+            table[f"top{i + 1}_prob"] = pd.array([row["probs"][i] if row["ids"] else None for row in rows],
+                                                 "Float32")
+            table[f"top{i + 1}_name"] = pd.array([row["names"][i] if row["ids"] else None for row in rows],
+                                                 "string")
+        part_path = os.path.join(self.path, f"part-{self.parts:06d}.parquet")
+        atomic_write(part_path, lambda tmp_path: table.to_parquet(tmp_path, index=False))
+        self.parts += 1
+        return {"parts": self.parts}
+
+    def close(self):
+        pass
+
+
+def bulk_predict(source, output, output_format=None, top_k=5, batch_size=256, num_threads=8, max_in_flight=None,
+                 resume=False, encoder_arch="imagenet", use_artifact=True, predictor=None):
+    # scores every image of a directory, tar or file list and streams the top k classes to output.
+    # Rows keep the input order, so the progress file only has to count the images that are done
+    output_format = output_format or os.path.splitext(output)[1].lstrip(".")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"The output format should be in {OUTPUT_FORMATS}")
+    # checked up front, a missing engine would otherwise only show when the first batch is written
+    if output_format == "parquet" and not any(importlib.util.find_spec(engine) for engine in PARQUET_ENGINES):
+        raise ImportError(f"Parquet output needs one of {PARQUET_ENGINES}, pip install pyarrow")
+    progress_path = output.rstrip("/") + ".progress"
+    progress = {"source": os.path.abspath(source), "done": 0, "offset": 0, "parts": 0}
+    if resume and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            progress = json.load(f)
+        if progress["source"] != os.path.abspath(source):
+            raise ValueError(f"{progress_path} belongs to {progress['source']}, not {source}")
+
+    if predictor is None:
+        predictor = Predictor(top_k=top_k, encoder_arch=encoder_arch, use_artifact=use_artifact)
+    if output_format == "parquet":
+        writer = ParquetWriter(output, predictor.top_k, progress["parts"])
+    else:
+        writer = LineWriter(output, output_format, predictor.top_k, progress["offset"])
+
+    # decoded images alive at any time: the queued decodes plus the batch being filled
+    max_in_flight = max_in_flight or 2 * batch_size
+    timings = {"decode_wait": 0.0, "decode_threads": 0.0, "compute": 0.0, "write": 0.0}
+    n_images, n_errors = 0, 0
+
+    def run_batch(batch):
+        nonlocal n_images, n_errors
+        st = time.perf_counter()
+        decoded = [tensor for _, tensor, _, _ in batch if tensor is not None]
+        prob, obj = predictor.topk_batch(decoded) if decoded else (None, None)
+        timings["compute"] += time.perf_counter() - st
+
+        st = time.perf_counter()
+        rows, row_no = [], 0
+        for name, tensor, error, _ in batch:
+            row = {"path": name, "error": error, "ids": [], "probs": [], "names": []}
+            if tensor is not None:
+                row["ids"] = obj[row_no].tolist()
+                row["probs"] = prob[row_no].tolist()
+                row["names"] = [get_image_class(class_id) for class_id in row["ids"]]
+                row_no += 1
+            rows.append(row)
+        progress.update(writer.write(rows))
+        progress["done"] += len(batch)
+
+        def write_progress(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(progress, f)
+        atomic_write(progress_path, write_progress)
+        timings["write"] += time.perf_counter() - st
+        n_images += len(batch)
+        n_errors += len(batch) - len(decoded)
+
+    def next_decoded(pending):
+        st = time.perf_counter()
+        result = pending.popleft().result()
+        timings["decode_wait"] += time.perf_counter() - st
+        timings["decode_threads"] += result[3]
+        return result
+
+    st = time.perf_counter()
+    with ThreadPoolExecutor(num_threads) as pool:
+        pending, batch = deque(), []
+        for item in iter_inputs(source, skip=progress["done"]):
+            pending.append(pool.submit(decode, item, predictor.preprocess))
+            while len(pending) >= max_in_flight or (pending and pending[0].done()):
+                batch.append(next_decoded(pending))
+                if len(batch) == batch_size:
+                    run_batch(batch)
+                    batch = []
+        while pending:
+            batch.append(next_decoded(pending))
+            if len(batch) == batch_size:
+                run_batch(batch)
+                batch = []
+        if batch:
+            run_batch(batch)
+    writer.close()
+    wall_time = time.perf_counter() - st
+
+    report = {"images": n_images, "errors": n_errors, "total_done": progress["done"], "wall_time_s": wall_time,
+              "images_per_sec": n_images / wall_time if wall_time else 0.0,
+              # decode_wait is the main thread blocked on the pool, the decode cost left after overlapping
+              "decode_share": timings["decode_wait"] / wall_time if wall_time else 0.0,
+              "compute_share": timings["compute"] / wall_time if wall_time else 0.0,
+              "write_share": timings["write"] / wall_time if wall_time else 0.0,
+              "decode_ms_per_image": timings["decode_threads"] / n_images * 1000 if n_images else 0.0}
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("source", help="an image directory, a tar of images or a text file with one path per line")
+    parser.add_argument("output", help=f"output file or parquet directory, the format follows the extension "
+                                       f"({', '.join(OUTPUT_FORMATS)}) unless --format is given")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--num-threads", type=int, default=8, help="decode threads")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="bound on images being decoded or waiting for a batch, twice the batch size by default")
+    parser.add_argument("--resume", action="store_true", help="continue after the last batch the progress file records")
+    parser.add_argument("--encoder-arch", choices=ENCODER_ARCHS, default="imagenet")
+    parser.add_argument("--no-artifact", action="store_true", help="run the eager model even if an export exists")
+    args = parser.parse_args()
+    report = bulk_predict(args.source, args.output, args.format, args.top_k, args.batch_size, args.num_threads,
+                          args.max_in_flight, args.resume, args.encoder_arch, not args.no_artifact)
+    print(f"{report['images']} images ({report['errors']} failed) in {report['wall_time_s']:.1f}s, "
+          f"{report['images_per_sec']:.1f} images/sec")
+    print(f"decode {report['decode_share']:.0%}  compute {report['compute_share']:.0%}  "
+          f"write {report['write_share']:.0%}  ({report['decode_ms_per_image']:.2f}ms decode per image "
+          f"over {args.num_threads} threads)")
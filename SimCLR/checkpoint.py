@@ -0,0 +1,147 @@
+import glob
+import os
+import random
+import sys
+import threading
+
+import numpy as np
+import torch
+from atomic_io import atomic_write
+
+# inference weights and training state live in separate files, so serving never unpickles the optimizer
+PRETEXT_CHECKPOINT = "simclr.pt"
+CLASSIFIER_CHECKPOINT = "classifier.pt"
+TRAINING_STATE = "training_state.pt"
+
+# the separate pickles written before the consolidated checkpoints, keyed by module name
+LEGACY_FILES = {"encoder": "encoder_load_state", "projection_head": "projection_head_load_state",
+                "layer1": "layer1", "layer2": "layer2"}
+
+
+def torch_save_atomic(path, obj):
+    # an interrupted save leaves the previous checkpoint intact
+    atomic_write(path, lambda tmp_path: torch.save(obj, tmp_path))
+
+
+def save_checkpoint(path, modules):
+    # one flat state dict, every key prefixed with the name of the module it belongs to
+    torch_save_atomic(path, to_cpu(module_state(modules)))
+
+
+def load_state(path, map_location="cpu", weights_only=True):
+    # mmap keeps the tensors on disk until a module copies them in, so untouched entries are never read
+    try:
+        return torch.load(path, map_location=map_location, mmap=True, weights_only=weights_only)
+    except TypeError:
+        return torch.load(path, map_location=map_location)
+
+
+def load_checkpoint(path, modules):
+    # restores only the given modules, the rest of the checkpoint stays unread
+    if not os.path.exists(path):
+        return load_legacy(os.path.dirname(path), modules)
+    load_module_state(load_state(path), modules)
+
+
+def load_legacy(save_dir, modules):
+    for name, module in modules.items():
+        module.load_state_dict(torch.load(os.path.join(save_dir, LEGACY_FILES[name]), map_location="cpu"))
+
+
+def convert_legacy(save_dir, names, path):
+    state = {}
+    for name in names:
+        for key, tensor in torch.load(os.path.join(save_dir, LEGACY_FILES[name]), map_location="cpu").items():
+            state[f"{name}.{key}"] = tensor
+    torch_save_atomic(path, state)
+
+
+def module_state(modules):
+    return {f"{name}.{key}": tensor for name, module in modules.items()
+            for key, tensor in module.state_dict().items()}
+
+
+def load_module_state(state, modules):
+    for name, module in modules.items():
+        prefix = f"{name}."
+        module.load_state_dict({key[len(prefix):]: tensor for key, tensor in state.items()
+                                if key.startswith(prefix)})
+
+
+def rng_state():
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def to_cpu(obj):
+    # copies every tensor, so training can keep updating the originals while the copy is written
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+class CheckpointWriter:
+    # writes training checkpoints from a background thread and keeps only the newest `keep` of them,
+    # a save waits for the previous write, so at most one snapshot is held in memory
+    def __init__(self, checkpoint_dir, prefix="pretext", keep=3):
+        # keep=0 would make the pruning slice [:-0] keep everything
+        if keep < 1:
+            raise ValueError("The number of kept checkpoints should be at least 1")
+        self.checkpoint_dir = checkpoint_dir
+        self.prefix = prefix
+        self.keep = keep
+        self.thread = None
+        self.error = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def checkpoints(self):
+        # zero padded step numbers, so the names sort in training order
+        return sorted(glob.glob(os.path.join(self.checkpoint_dir, f"{self.prefix}_*.pt")))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, step, state):
+        self.wait()
+        path = os.path.join(self.checkpoint_dir, f"{self.prefix}_{step:08d}.pt")
+        self.thread = threading.Thread(target=self.__write, args=(path, to_cpu(state)))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __write(self, path, state):
+        try:
+            torch_save_atomic(path, state)
+            for old_path in self.checkpoints()[:-self.keep]:
+                os.remove(old_path)
+        except Exception as e:
+            self.error = e
+
+
+if __name__ == "__main__":
+    # python checkpoint.py <save_dir>: merge the old separate pickles into the consolidated checkpoints
+    save_dir = sys.argv[1] if len(sys.argv) > 1 else "./SimCLR"
+    convert_legacy(save_dir, ["encoder", "projection_head"], os.path.join(save_dir, PRETEXT_CHECKPOINT))
+    convert_legacy(save_dir, ["encoder", "projection_head", "layer1", "layer2"],
+                   os.path.join(save_dir, CLASSIFIER_CHECKPOINT))
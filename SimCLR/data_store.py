@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import torch
+from torchvision.datasets import CIFAR10, CIFAR100
+from atomic_io import atomic_write
+
+DATA_ROOT_PATH = './DataPrep/dataset'
+
+
+def to_uint8_tensor(imgs):
+    # HWC / NHWC uint8 arrays to CHW / NCHW uint8 tensors, scaling to float happens on the device
+    imgs = torch.from_numpy(np.ascontiguousarray(imgs))
+    return imgs.movedim(-1, -3).contiguous()
+
+
+def store_dir(dataset_name, root=DATA_ROOT_PATH):
+    return os.path.join(root, f"{dataset_name.lower()}_store")
+
+
+def np_save_atomic(path, array):
+    # through a file object, np.save would append .npy to the temporary name
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+    atomic_write(path, write)
+
+
+def build_store(dataset_name, root=DATA_ROOT_PATH):
+    # one-time conversion of the torchvision pickles into contiguous uint8 NHWC + labels .npy files,
+    # the train images come first and the test images after them
+    valid_models = ["cifar10", "cifar100"]
+    if dataset_name.lower() not in valid_models:
+        raise ValueError(f"The data should be in {valid_models}")
+    data_src = CIFAR10 if dataset_name.lower() == "cifar10" else CIFAR100
+
+    c_train = data_src(root, download=True, train=True)
+    c_test = data_src(root, download=True, train=False)
+    out_dir = store_dir(dataset_name, root)
+    os.makedirs(out_dir, exist_ok=True)
+    np_save_atomic(os.path.join(out_dir, "images.npy"),
+                   np.ascontiguousarray(np.concatenate((c_train.data, c_test.data)), dtype=np.uint8))
+    np_save_atomic(os.path.join(out_dir, "labels.npy"),
+                   np.asarray(c_train.targets + c_test.targets, dtype=np.int64))
+    # written last, so a store without it is an interrupted conversion
+    np_save_atomic(os.path.join(out_dir, "n_train.npy"), np.asarray(len(c_train.data)))
+    return out_dir
+
+
+class CIFARStore:
+    # opens the arrays lazily and drops them when pickled, so every DataLoader worker
+    # maps the same files instead of receiving a copy of the data
+    def __init__(self, dataset_name, root=DATA_ROOT_PATH):
+        self.dataset_name = dataset_name.lower()
+        self.store_dir = store_dir(dataset_name, root)
+        if not os.path.exists(os.path.join(self.store_dir, "n_train.npy")):
+            build_store(dataset_name, root)
+        self.n_train = int(np.load(os.path.join(self.store_dir, "n_train.npy")))
+        self._images = None
+        self._labels = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.store_dir, "images.npy"), mmap_mode="r")
+        return self._images
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = np.load(os.path.join(self.store_dir, "labels.npy"), mmap_mode="r")
+        return self._labels
+
+    def __len__(self):
+        return len(self.images)
+
+    def train_indices(self):
+        return np.arange(self.n_train)
+
+    def test_indices(self):
+        return np.arange(self.n_train, len(self))
+
+    def split_indices(self, val_fraction=0.2, seed=0):
+        # seeded split of the train part, saved next to the store so every run and worker reuses it
+        split_path = os.path.join(self.store_dir, f"split_seed{seed}_val{val_fraction}.npz")
+        if not os.path.exists(split_path):
+            perm = np.random.default_rng(seed).permutation(self.n_train)
+            n_val = int(round(self.n_train * val_fraction))
+
+            def write(tmp_path):
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, train=np.sort(perm[n_val:]), val=np.sort(perm[:n_val]))
+            atomic_write(split_path, write)
+        with np.load(split_path) as split:
+            return split["train"], split["val"]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        state["_labels"] = None
+        return state
+
+
+if __name__ == "__main__":
+    for name in ["cifar10", "cifar100"]:
+        store = CIFARStore(name)
+        print(name, store.images.shape, store.labels.shape, store.n_train)
@@ -0,0 +1,113 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed():
+    # torchrun sets RANK/WORLD_SIZE/LOCAL_RANK and srun the SLURM_* variables, a plain run stays single-process
+    rank = int(os.environ.get("RANK", os.environ.get("SLURM_PROCID", 0)))
+    world_size = int(os.environ.get("WORLD_SIZE", os.environ.get("SLURM_NTASKS", 1)))
+    local_rank = int(os.environ.get("LOCAL_RANK", os.environ.get("SLURM_LOCALID", 0)))
+    if world_size > 1 and not dist.is_initialized():
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        if torch.cuda.is_available():
+            # the index-less cuda DEVICE then resolves to this rank's gpu
+            torch.cuda.set_device(local_rank)
+        dist.init_process_group("nccl" if torch.cuda.is_available() else "gloo", rank=rank, world_size=world_size)
+    return rank, world_size
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def gather_objects(obj):
+    # one entry per rank, a single-process run gets a list of one
+    if not is_distributed():
+        return [obj]
+    objects = [None] * dist.get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def cleanup():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+class GatherLayer(torch.autograd.Function):
+    # all_gather that keeps the graph: the gradient of every gathered copy is summed over the ranks
+    # and each rank gets back the slice that belongs to its own input
+    @staticmethod
+    def forward(ctx, x):
+        output = [torch.zeros_like(x) for _ in range(dist.get_world_size())]
+        dist.all_gather(output, x.contiguous())
+        return tuple(output)
+
+    @staticmethod
+    def backward(ctx, *grads):
+        all_grads = torch.stack(grads)
+        dist.all_reduce(all_grads)
+        return all_grads[dist.get_rank()]
+
+
+def all_gather_with_grad(x):
+    return torch.cat(GatherLayer.apply(x))
+
+
+def _check_ntxent(rank, world_size, z_org, z_aug, mode, results):
+    # each rank holds one shard of a fixed global batch, the loss averaged over the ranks and
+    # the summed-over-ranks input gradient have to match the single-process global loss
+    from SimCLRLoss import NTXent
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = "29511"
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    n = z_org.shape[0] // world_size
+    shard = slice(rank * n, (rank + 1) * n)
+    local_org = z_org[shard].clone().requires_grad_()
+    local_aug = z_aug[shard].clone().requires_grad_()
+    loss = NTXent(n, 0.5, mode=mode, chunk_size=3)(local_org, local_aug)
+    loss.backward()
+    results[rank] = (loss.item(), local_org.grad, local_aug.grad)
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    import torch.multiprocessing as mp
+    from SimCLRLoss import NTXent
+
+    world_size = 2
+    z_org = torch.randn(8, 16, dtype=torch.float64)
+    z_aug = torch.randn(8, 16, dtype=torch.float64)
+    ref_org = z_org.clone().requires_grad_()
+    ref_aug = z_aug.clone().requires_grad_()
+    ref_loss = NTXent(8, 0.5)(ref_org, ref_aug)
+    ref_loss.backward()
+    for mode in ["matmul", "chunked"]:
+        results = mp.Manager().dict()
+        mp.spawn(_check_ntxent, args=(world_size, z_org, z_aug, mode, results), nprocs=world_size)
+        loss = sum(results[rank][0] for rank in range(world_size)) / world_size
+        # DistributedDataParallel averages over the ranks, which cancels the world_size factor
+        grad_org = torch.cat([results[rank][1] for rank in range(world_size)]) / world_size
+        grad_aug = torch.cat([results[rank][2] for rank in range(world_size)]) / world_size
+        print(mode, abs(loss - ref_loss.item()) < 1e-10,
+              torch.allclose(grad_org, ref_org.grad), torch.allclose(grad_aug, ref_aug.grad))
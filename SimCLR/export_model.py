@@ -0,0 +1,49 @@
+import argparse
+import logging
+import os
+
+import torch
+from SimCLR import Clssifier, SAVE_DIR, DEVICE, ENCODER_ARCHS
+from checkpoint import CLASSIFIER_CHECKPOINT
+from atomic_io import atomic_write
+
+INFERENCE_ARTIFACT = "classifier_scripted.pt"
+
+
+def export_predictor(n_class=100, encoder_arch="imagenet", save_path=SAVE_DIR, example_size=32):
+    # traces the fine tuned classifier on float [0, 1] batches, the input the Predictor hands it
+    model = Clssifier(n_class, 0, pretrained=False, encoder_arch=encoder_arch)
+    model.load_model(load_optim=False, save_path=save_path)
+    model.eval()
+    example = torch.rand(1, 3, example_size, example_size, device=DEVICE)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        # freezing turns the weights into constants and folds conv + bn. The device specific
+        # optimize_for_inference rewrite cannot be serialized, load_artifact applies it on request
+        frozen = torch.jit.freeze(traced)
+
+    return atomic_write(os.path.join(save_path, INFERENCE_ARTIFACT), lambda tmp_path: torch.jit.save(frozen, tmp_path))
+
+
+def load_artifact(save_path=SAVE_DIR, device=DEVICE, optimize=False):
+    # None when nothing was exported or the checkpoint changed after the export.
+    # On cpu the mkldnn rewrite of optimize=True only pays off for large batches, single requests
+    # are faster on the frozen graph (benchmark.py export)
+    path = os.path.join(save_path, INFERENCE_ARTIFACT)
+    if not os.path.exists(path):
+        return None
+    checkpoint_path = os.path.join(save_path, CLASSIFIER_CHECKPOINT)
+    if os.path.exists(checkpoint_path) and os.path.getmtime(checkpoint_path) > os.path.getmtime(path):
+        logging.warning(f"{path} is older than {checkpoint_path}, re-run export_model.py")
+        return None
+    model = torch.jit.load(path, map_location=device)
+    return torch.jit.optimize_for_inference(model) if optimize else model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoder-arch", choices=ENCODER_ARCHS, default="imagenet",
+                        help="has to match the arch the classifier checkpoint was trained with")
+    parser.add_argument("--n-class", type=int, default=100)
+    args = parser.parse_args()
+    print(f"exported {export_predictor(args.n_class, args.encoder_arch)}")
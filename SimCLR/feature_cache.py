@@ -0,0 +1,66 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from data_store import np_save_atomic
+from atomic_io import atomic_write
+from metrics import eval_mode
+
+FEATURE_CACHE_DIR = './DataPrep/features'
+
+
+def state_dict_hash(state_dict):
+    h = hashlib.sha1()
+    for name, tensor in sorted(state_dict.items()):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+class FeatureCache:
+    # encoder outputs of a frozen encoder, stored as float32 .npy memory maps under a directory
+    # named after the hash of the encoder weights, so changed weights never hit a stale cache
+    def __init__(self, encoder, dataset_name, cache_dir=FEATURE_CACHE_DIR):
+        self.encoder = encoder
+        self.key = state_dict_hash(encoder.model.state_dict())
+        self.dataset_dir = os.path.join(cache_dir, dataset_name.lower())
+        self.cache_dir = os.path.join(self.dataset_dir, self.key)
+
+    def features(self, task, dataset, batch_size=512, num_workers=3):
+        features_path = os.path.join(self.cache_dir, f"{task}_features.npy")
+        labels_path = os.path.join(self.cache_dir, f"{task}_labels.npy")
+        if not os.path.exists(labels_path):
+            self.__build(dataset, features_path, labels_path, batch_size, num_workers)
+        return np.load(features_path, mmap_mode="r"), np.load(labels_path)
+
+    def __build(self, dataset, features_path, labels_path, batch_size, num_workers):
+        if not os.path.isdir(self.cache_dir):
+            # caches of older encoder weights can never be hit again
+            if os.path.isdir(self.dataset_dir):
+                shutil.rmtree(self.dataset_dir)
+            os.makedirs(self.cache_dir)
+        dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
+
+        labels = np.empty(len(dataset), dtype=np.int64)
+
+        def write(tmp_path):
+            features = None
+            st = 0
+            with torch.inference_mode():
+                for batch_data, batch_label in dataloader:
+                    z = self.encoder(batch_data).float().cpu().numpy()
+                    if features is None:
+                        features = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                             shape=(len(dataset), z.shape[1]))
+                    features[st:st + len(z)] = z
+                    labels[st:st + len(z)] = batch_label.numpy()
+                    st += len(z)
+            features.flush()
+
+        with eval_mode(self.encoder.model):
+            atomic_write(features_path, write)
+        # the labels file is written last and marks the split as complete
+        np_save_atomic(labels_path, labels)
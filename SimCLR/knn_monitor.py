@@ -0,0 +1,42 @@
+import torch
+import torch.nn.functional as F
+
+
+class KNNMonitor:
+    # weighted kNN classifier (Wu et al. 2018) over the pretext embeddings of a labeled subset. The bank is
+    # filled from the original-view embeddings every training step computes anyway, so keeping it costs no
+    # extra forward pass, only the queries are embedded when the monitor is evaluated
+    def __init__(self, bank_indices, bank_labels, data_len, n_classes, device, k=200, temperature=0.1):
+        self.n_classes = n_classes
+        self.device = device
+        self.k = min(k, len(bank_indices))
+        self.temperature = temperature
+        # dataset index -> bank row, -1 for images outside the labeled subset
+        self.slots = torch.full((data_len,), -1, dtype=torch.long)
+        self.slots[torch.as_tensor(bank_indices)] = torch.arange(len(bank_indices))
+        self.labels = torch.as_tensor(bank_labels, dtype=torch.long, device=device)
+        self.bank = None
+        self.filled = torch.zeros(len(bank_indices), dtype=torch.bool, device=device)
+
+    def update(self, indices, z):
+        slots = self.slots[indices]
+        keep = slots >= 0
+        if not keep.any():
+            return
+        z = F.normalize(z.detach()[keep.to(z.device)].float(), dim=1)
+        if self.bank is None:
+            self.bank = torch.zeros(len(self.filled), z.shape[1], device=self.device)
+        slots = slots[keep].to(self.device)
+        self.bank[slots] = z
+        self.filled[slots] = True
+
+    def votes(self, z):
+        # class scores of the queries, the similarity weighted labels of their k nearest bank entries.
+        # Scored in fp32 even when called under bf16/fp16 autocast, the float32 votes need float32 weights
+        with torch.autocast(z.device.type, enabled=False):
+            sim = F.normalize(z.float(), dim=1) @ self.bank.T
+            sim.masked_fill_(~self.filled, float("-inf"))
+            top_sim, top_idx = sim.topk(self.k, dim=1)
+            weights = (top_sim / self.temperature).exp()
+            votes = torch.zeros(len(z), self.n_classes, device=z.device)
+            return votes.scatter_add_(1, self.labels[top_idx], weights)
@@ -0,0 +1,68 @@
+import contextlib
+
+import torch
+from torch.utils.data import DataLoader
+from perf import autocast
+
+
+class MetricsAccumulator:
+    # loss sum and top-k hit counts kept as device tensors, nothing is copied to the host until compute()
+    def __init__(self, device, topk=(1, 10)):
+        self.device = device
+        self.topk = topk
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), device=self.device)
+        self.hits = torch.zeros(len(self.topk), device=self.device)
+        self.count = 0
+
+    def update(self, loss, logits=None, labels=None, n=None):
+        if n is None:
+            n = len(labels) if labels is not None else 1
+        self.loss_sum += loss.detach().float() * n
+        if logits is not None:
+            max_k = min(max(self.topk), logits.shape[1])
+            top = logits.detach().topk(max_k, dim=1).indices == labels.unsqueeze(1)
+            self.hits += torch.stack([top[:, :k].any(dim=1).sum() for k in self.topk]).float()
+        self.count += n
+
+    def compute(self):
+        count = max(self.count, 1)
+        stats = {"loss": self.loss_sum.item() / count}
+        for k, hits in zip(self.topk, (self.hits / count).tolist()):
+            stats[f"top{k}"] = hits
+        return stats
+
+
+@contextlib.contextmanager
+def eval_mode(*modules):
+    # every module in eval mode for the block, the previous train/eval modes are restored afterwards, also
+    # when the block fails, training must not continue with frozen BatchNorm
+    was_training = [module.training for module in modules]
+    for module in modules:
+        module.eval()
+    try:
+        yield
+    finally:
+        for module, training in zip(modules, was_training):
+            module.train(training)
+
+
+def evaluate(model_fn, dataloader, device, modules=(), criterion=None, topk=(1, 10), amp_dtype=None):
+    # one pass over dataloader under inference_mode with every module in eval mode (BatchNorm uses its
+    # running stats and stays untouched), the previous train/eval modes are restored afterwards
+    metrics = MetricsAccumulator(device, topk)
+    with eval_mode(*modules), torch.inference_mode(), autocast(device, amp_dtype):
+        for batch_data, batch_label in dataloader:
+            batch_label = batch_label.to(device, non_blocking=True)
+            z = model_fn(batch_data.to(device, non_blocking=True))
+            loss = criterion(z, batch_label) if criterion is not None else torch.zeros((), device=device)
+            metrics.update(loss, z, batch_label)
+    return metrics.compute()
+
+
+def eval_dataloader(dataset, batch_size, num_workers=3):
+    # evaluation needs no shuffling and, without autograd buffers, can afford larger batches
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True,
+                      persistent_workers=num_workers > 0)
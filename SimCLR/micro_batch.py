@@ -0,0 +1,67 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+MAX_BATCH_SIZE = 32
+MAX_WAIT_MS = 5
+
+
+class MicroBatcher:
+    def __init__(self, predictor, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.n_batches = 0
+        self.__queue = queue.Queue()
+        self.__worker = threading.Thread(target=self.__run, name="micro-batcher", daemon=True)
+        self.__worker.start()
+
+    def submit(self, image):
+        # preprocessing happens on the caller's thread, only the forward pass is batched
+        future = Future()
+        self.__queue.put((self.predictor.preprocess(image), future, time.perf_counter()))
+        return future
+
+    def predict(self, image, timeout=None):
+        return self.submit(image).result(timeout)
+
+    def close(self):
+        self.__queue.put(None)
+        self.__worker.join()
+
+    def __collect(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self.__queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self.__queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def __run(self):
+        while True:
+            first = self.__queue.get()
+            if first is None:
+                break
+            batch = self.__collect(first)
+            images, futures, starts = zip(*batch)
+            try:
+                preds = self.predictor.predict_batch(list(images))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.n_batches += 1
+            done = time.perf_counter()
+            for pred, future, st in zip(preds, futures, starts):
+                self.predictor.record_latency(done - st)
+                future.set_result(pred)
@@ -0,0 +1,70 @@
+import contextlib
+import time
+
+import torch
+
+VALID_PRECISIONS = ["fp32", "bf16", "fp16"]
+
+
+def autocast_dtype(precision, device):
+    if precision not in VALID_PRECISIONS:
+        raise ValueError(f"The precision should be in {VALID_PRECISIONS}")
+    if precision == "fp32":
+        return None
+    if precision == "fp16" and device.type != "cuda":
+        print(f"fp16 autocast needs cuda, using bf16 on {device}")
+        return torch.bfloat16
+    return torch.float16 if precision == "fp16" else torch.bfloat16
+
+
+def autocast(device, dtype):
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def grad_scaler(device, dtype):
+    # only fp16 needs loss scaling, for fp32/bf16 the scaler is a pass-through
+    enabled = dtype == torch.float16
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler(device.type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def rss_peak_mb():
+    # VmHWM belongs to this address space, ru_maxrss would carry over a parent's peak
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def reset_peak_memory(device):
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return rss_peak_mb()
+
+
+class StepTimer:
+    # mean step time over an epoch, synchronizing with the device only when summarized
+    def __init__(self, device):
+        self.device = device
+        self.n_steps = 0
+        reset_peak_memory(device)
+        self.st = time.perf_counter()
+
+    def step(self):
+        self.n_steps += 1
+
+    def summary(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - self.st
+        step_ms = elapsed / max(self.n_steps, 1) * 1000
+        return f"step time {step_ms:.1f}ms, peak memory {peak_memory_mb(self.device):.0f}MB"
@@ -1,42 +1,146 @@
+import io
 import os
+import threading
+import time
 
+import numpy as np
 import torch
 from torchvision import transforms
 from SimCLR import *
+from export_model import load_artifact
 from PIL import Image
 from torchvision.datasets import CIFAR10, CIFAR100
 import logging
+# uploads larger than this are refused before decoding, app_.py passes it to decode_image and to flask as MAX_CONTENT_LENGTH
+MAX_UPLOAD_BYTES = 20 * 2 ** 20
+# checked on the image header, so a small file that expands to a huge bitmap is refused too
+MAX_IMAGE_PIXELS = 50_000_000
 
-transform = transforms.Compose([transforms.ToTensor(),
-                                transforms.Resize(32)
+# uint8 until after the resize, only the 32 pixel image is converted to float.
+# The center crop gives every upload the same 32x32 shape, whatever its aspect ratio, so requests can share a batch
+transform = transforms.Compose([transforms.PILToTensor(),
+                                transforms.Resize(32, antialias=True),
+                                transforms.CenterCrop(32),
+                                transforms.ConvertImageDtype(torch.float)
                                 ])
 
 
+def decode_image(source, size=32, max_bytes=None):
+    # source is encoded bytes, a path or a file object. JPEGs are decoded with DCT scaling (PIL draft mode)
+    # at the smallest 1/2 .. 1/8 scale that still covers size x size, the full resolution is never materialized.
+    # max_bytes caps encoded uploads, offline inputs are not capped whether they come as bytes or paths
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        if max_bytes is not None and len(source) > max_bytes:
+            raise ValueError(f"The upload should be at most {max_bytes} bytes")
+        source = io.BytesIO(source)
+    try:
+        img = Image.open(source)
+    except Image.DecompressionBombError as e:
+        # PIL's own limit (about 179M pixels) fires in open, before the check below, and is not an OSError
+        raise ValueError(f"The image should have at most {MAX_IMAGE_PIXELS} pixels") from e
+    if img.width * img.height > MAX_IMAGE_PIXELS:
+        raise ValueError(f"The image should have at most {MAX_IMAGE_PIXELS} pixels")
+    img.draft("RGB", (size, size))
+    return img.convert("RGB")
+
+
+class Predictor:
+    def __init__(self, n_class=100, top_k=10, warmup_size=32, model=None, encoder_arch="imagenet", use_artifact=True):
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.top_k = top_k
+
+        st = time.perf_counter()
+        # the exported TorchScript classifier when there is one, the python model class otherwise
+        if model is None and use_artifact:
+            model = load_artifact(device=self.device)
+        self.backend = "torchscript" if isinstance(model, torch.jit.ScriptModule) else "eager"
+        if model is None:
+            model = Clssifier(n_class, 0, pretrained=False, encoder_arch=encoder_arch)
+            model.load_model(load_optim=False)
+        self.model = model
+        self.model.eval()
+        self.load_time = time.perf_counter() - st
+
+        st = time.perf_counter()
+        with torch.inference_mode():
+            self.model(torch.zeros(1, 3, warmup_size, warmup_size, device=self.device))
+        self.warmup_time = time.perf_counter() - st
+
+        self.n_requests = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.__stats_lock = threading.Lock()
+        logging.info(f"{self.backend} predictor loaded in {self.load_time:.3f}s, warm-up took {self.warmup_time:.3f}s")
+
+    def preprocess(self, image):
+        # a PIL image from decode_image, or an RGB uint8 array
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        return transform(image.convert("RGB"))
+
+    def predict(self, image):
+        st = time.perf_counter()
+        pred = self.predict_batch([self.preprocess(image)])[0]
+        self.record_latency(time.perf_counter() - st)
+        return pred
+
+    def predict_batch(self, images):
+        prob, obj = self.topk_batch(images)
+        preds = []
+        for prob_row, obj_row in zip(prob, obj):
+            pred = {}
+            for p, o in zip(prob_row, obj_row):
+                pr = str(round(p*100, 2))
+                pred[pr] = int(o)
+            preds.append(pred)
+        return preds
+
+    def topk_batch(self, images):
+        # top_k probabilities and class ids, one row per image. preprocess makes every image 3x32x32,
+        # so the whole list is one forward pass
+        batch = torch.stack(images).to(self.device)
+        with torch.inference_mode():
+            output = torch.softmax(self.model(batch), dim=1)
+            prob, obj = output.topk(self.top_k)
+        return prob.float().cpu().numpy(), obj.cpu().numpy()
+
+    def record_latency(self, latency):
+        with self.__stats_lock:
+            self.n_requests += 1
+            self.total_latency += latency
+            self.last_latency = latency
+
+    def stats(self):
+        with self.__stats_lock:
+            mean_latency = self.total_latency / self.n_requests if self.n_requests else 0.0
+            return {"backend": self.backend,
+                    "load_time_s": self.load_time,
+                    "warmup_time_s": self.warmup_time,
+                    "requests": self.n_requests,
+                    "last_latency_ms": self.last_latency * 1000,
+                    "mean_latency_ms": mean_latency * 1000}
+
+
+_predictor = None
+_predictor_lock = threading.Lock()
+
+
+def get_predictor():
+    # one warm model per process, shared by streamlit reruns and flask requests
+    global _predictor
+    if _predictor is None:
+        with _predictor_lock:
+            if _predictor is None:
+                _predictor = Predictor()
+    return _predictor
+
+
 def image_prediction(image):
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(os.getcwd())
-    logging.info(os.listdir('.'))
-    model = Clssifier(100, 0)
-    model.load_model()
-    model.eval()
-    image_ = transform(image).unsqueeze(0).to(device)
-    output = model(image_)
-    output = torch.softmax(output, dim=1)
-    prob, obj = output.topk(10)
-    if torch.cuda.is_available():
-        prob = prob.cpu()
-        obj = obj.cpu()
-    prob = prob.detach().numpy().reshape(-1)
-    obj = obj.detach().numpy().reshape(-1)
-    pred = {}
-    for p, o in zip(prob, obj):
-        pr = str(round(p*100, 2))
-        pred[pr] = o
-    return pred
+    return get_predictor().predict(image)
 
 
 def load_image(image_file):
-    img = Image.open(image_file)
+    img = decode_image(image_file)
     return img
 
 
@@ -47,4 +151,5 @@ if __name__ == '__main__':
     img_file_path = r"C:\Users\conta\Downloads\Screenshot 2023-05-10 092429.jpg"
     img = load_image(img_file_path)
     pred = image_prediction(img)
-    print(pred)
\ No newline at end of file
+    print(pred)
+    print(get_predictor().stats())
@@ -0,0 +1,39 @@
+import torch
+
+
+class PrefixCache:
+    # outputs of the frozen encoder prefix by dataset index, for inputs that come back unchanged every epoch
+    # (the original view of pretext training). Items past the memory budget are simply not cached
+    def __init__(self, n_items, max_mb):
+        self.slots = torch.full((n_items,), -1, dtype=torch.long)
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.bank = None
+        self.n_used = 0
+
+    def run(self, x, keys, prefix_fn):
+        # keys has one dataset index per row of x, -1 for rows that must not be cached
+        keys = torch.as_tensor(keys, dtype=torch.long).cpu()
+        valid = keys >= 0
+        slots = torch.full_like(keys, -1)
+        slots[valid] = self.slots[keys[valid]]
+        hit = slots >= 0
+        if self.bank is not None and hit.all():
+            return self.bank[slots.to(self.bank.device)]
+
+        miss = ~hit
+        h_miss = prefix_fn(x[miss.to(x.device)])
+        if self.bank is None:
+            capacity = min(len(self.slots), self.max_bytes // max(h_miss[0].nbytes, 1))
+            self.bank = torch.empty((capacity, *h_miss.shape[1:]), dtype=h_miss.dtype, device=h_miss.device)
+        out = torch.empty((len(keys), *h_miss.shape[1:]), dtype=h_miss.dtype, device=h_miss.device)
+        out[miss.to(out.device)] = h_miss
+        if hit.any():
+            out[hit.to(out.device)] = self.bank[slots[hit].to(self.bank.device)]
+
+        rows = torch.nonzero(miss & valid).flatten()[:len(self.bank) - self.n_used]
+        if len(rows):
+            new_slots = torch.arange(self.n_used, self.n_used + len(rows))
+            self.bank[new_slots.to(self.bank.device)] = out[rows.to(out.device)]
+            self.slots[keys[rows]] = new_slots
+            self.n_used += len(rows)
+        return out
@@ -0,0 +1,300 @@
+import argparse
+import logging
+import os
+import threading
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+from SimCLR import SimCLR, SAVE_DIR, ENCODER_ARCHS
+from predict_image import decode_image
+from atomic_io import atomic_write
+from metrics import eval_mode
+
+RETRIEVAL_DIR = os.path.join(SAVE_DIR, "retrieval")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+# catalog images and queries are embedded from the same square uint8 crop
+retrieval_transform = transforms.Compose([transforms.PILToTensor(),
+                                          transforms.Resize(32),
+                                          transforms.CenterCrop(32)
+                                          ])
+
+
+def list_images(image_dir):
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(image_dir)
+                  for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+class ImageFiles(Dataset):
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        # the same reduced scale decode as the /similar queries. An unreadable file comes back as a blank
+        # image with index -1 and is left out of the catalog instead of failing the whole build
+        try:
+            return retrieval_transform(decode_image(self.paths[idx])), idx
+        except (OSError, ValueError) as e:
+            logging.warning(f"skipping {self.paths[idx]}: {type(e).__name__}: {e}")
+            return torch.zeros((3, 32, 32), dtype=torch.uint8), -1
+
+
+def embed(simclr, batch):
+    z = simclr(batch).float()
+    return torch.nn.functional.normalize(z, dim=1)
+
+
+def extract_embeddings(simclr, dataset, out_path, batch_size=256, num_workers=3):
+    # streams L2 normalized SimCLR embeddings of the dataset into an .npy memory map, one batch in memory at a time.
+    # Items the dataset returns with index -1 are skipped, the dataset indices of the stored rows come back with them
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True)
+    embedded = []
+
+    def write(tmp_path):
+        embeddings = None
+        st = 0
+        with torch.inference_mode():
+            for batch_data, batch_idx in dataloader:
+                keep = batch_idx >= 0
+                if not keep.any():
+                    continue
+                z = embed(simclr, batch_data[keep]).cpu().numpy()
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                           shape=(len(dataset), z.shape[1]))
+                embeddings[st:st + len(z)] = z
+                embedded.append(batch_idx[keep].numpy())
+                st += len(z)
+        if embeddings is None:
+            np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(0, 0)).flush()
+        else:
+            embeddings.flush()
+
+    with eval_mode(simclr.base_enc.model, simclr.projection_head):
+        atomic_write(out_path, write)
+    embedded = np.concatenate(embedded) if embedded else np.empty(0, dtype=np.int64)
+    embeddings = np.load(out_path, mmap_mode="r")
+    if len(embedded) < len(embeddings):
+        # skipped items left unused rows at the end, the file is cut down to the stored ones block by block
+        def compact(tmp_path, block_size=65536):
+            out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                            shape=(len(embedded), embeddings.shape[1]))
+            for st in range(0, len(embedded), block_size):
+                out[st:st + block_size] = embeddings[st:min(st + block_size, len(embedded))]
+            out.flush()
+        atomic_write(out_path, compact)
+        embeddings = np.load(out_path, mmap_mode="r")
+    return embeddings, embedded
+
+
+def _top_k(scores, k):
+    # unsorted top k per row with argpartition, then sorted by score
+    k = min(k, scores.shape[1])
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1)
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(idx, order, axis=1)
+
+
+def brute_force_search(vectors, queries, k=10, block_size=65536):
+    # exact inner product top k, scanning the vectors in blocks so a memmap store never has to fit in memory
+    best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    for st in range(0, len(vectors), block_size):
+        scores, idx = _top_k(queries @ np.asarray(vectors[st:st + block_size]).T, k)
+        scores, pick = _top_k(np.concatenate((best_scores, scores), axis=1), k)
+        best_ids = np.take_along_axis(np.concatenate((best_ids, idx + st), axis=1), pick, axis=1)
+        best_scores = scores
+    return best_scores, best_ids
+
+
+class IVFIndex:
+    # inverted file index over normalized vectors: k-means centroids split the vectors into n_lists lists,
+    # a query is only scored against the n_probe lists whose centroids are closest to it
+    def __init__(self, dim, n_lists=256, n_probe=8):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None
+        self.lists = [np.empty((0, dim), dtype=np.float32) for _ in range(n_lists)]
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self.next_id = 0
+
+    def __len__(self):
+        return self.next_id
+
+    def train(self, vectors, n_iter=10, sample_size=None, seed=0):
+        # spherical k-means on a sample, the centroids stay fixed once vectors are added
+        rng = np.random.default_rng(seed)
+        sample_size = min(len(vectors), sample_size or 64 * self.n_lists)
+        sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))],
+                            dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, self.n_lists, replace=False)]
+        for _ in range(n_iter):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, sample)
+            empty = ~np.bincount(assign, minlength=self.n_lists).astype(bool)
+            # an empty list restarts from a random sample instead of staying dead
+            sums[empty] = sample[rng.choice(sample_size, empty.sum())]
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+        self.centroids = centroids.astype(np.float32)
+
+    def add(self, vectors, ids=None, block_size=65536):
+        # appends to the lists, ids default to the running count of added vectors
+        if self.centroids is None:
+            raise ValueError("The index should be trained before vectors are added")
+        if ids is None:
+            ids = np.arange(self.next_id, self.next_id + len(vectors))
+        ids = np.asarray(ids, dtype=np.int64)
+        for st in range(0, len(vectors), block_size):
+            block = np.asarray(vectors[st:st + block_size], dtype=np.float32)
+            block_ids = ids[st:st + block_size]
+            assign = np.argmax(block @ self.centroids.T, axis=1)
+            for list_no in np.unique(assign):
+                members = assign == list_no
+                self.lists[list_no] = np.concatenate((self.lists[list_no], block[members]))
+                self.list_ids[list_no] = np.concatenate((self.list_ids[list_no], block_ids[members]))
+        self.next_id = max(self.next_id, int(ids.max()) + 1) if len(ids) else self.next_id
+
+    def search(self, queries, k=10, n_probe=None):
+        # every probed list scores all the queries that probe it with one matmul, the per-list top k
+        # candidates are then merged per query
+        queries = np.asarray(queries, dtype=np.float32)
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        probes = _top_k(queries @ self.centroids.T, n_probe)[1]
+        cand_scores = np.full((len(queries), n_probe, k), -np.inf, dtype=np.float32)
+        cand_ids = np.full((len(queries), n_probe, k), -1, dtype=np.int64)
+        for list_no in np.unique(probes):
+            if len(self.lists[list_no]) == 0:
+                continue
+            query_idx, slot = np.nonzero(probes == list_no)
+            scores, idx = _top_k(queries[query_idx] @ self.lists[list_no].T, k)
+            cand_scores[query_idx, slot, :scores.shape[1]] = scores
+            cand_ids[query_idx, slot, :scores.shape[1]] = self.list_ids[list_no][idx]
+        scores, pick = _top_k(cand_scores.reshape(len(queries), -1), k)
+        return scores, np.take_along_axis(cand_ids.reshape(len(queries), -1), pick, axis=1)
+
+    def save(self, path):
+        sizes = np.array([len(ids) for ids in self.list_ids])
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.savez(f, centroids=self.centroids, n_probe=self.n_probe, next_id=self.next_id, sizes=sizes,
+                         vectors=np.concatenate(self.lists), ids=np.concatenate(self.list_ids))
+        atomic_write(path, write)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            index = cls(f["centroids"].shape[1], len(f["centroids"]), int(f["n_probe"]))
+            index.centroids = f["centroids"]
+            index.next_id = int(f["next_id"])
+            bounds = np.cumsum(f["sizes"])[:-1]
+            index.lists = np.split(f["vectors"], bounds)
+            index.list_ids = np.split(f["ids"], bounds)
+        return index
+
+
+class Retriever:
+    # the pretext SimCLR plus the IVF index and the catalog paths written by `python retrieval.py`
+    def __init__(self, retrieval_dir=RETRIEVAL_DIR, encoder_arch="imagenet", top_k=10):
+        self.top_k = top_k
+        # the index first, without a catalog this fails before any model is loaded
+        self.index = IVFIndex.load(os.path.join(retrieval_dir, "index.npz"))
+        with open(os.path.join(retrieval_dir, "paths.txt")) as f:
+            self.paths = f.read().splitlines()
+        self.simclr = SimCLR(0, encoder_arch=encoder_arch)
+        self.simclr.load_model(SAVE_DIR)
+        self.simclr.base_enc.model.eval()
+        self.simclr.projection_head.eval()
+
+    def query(self, images, k=None):
+        # PIL images from decode_image or RGB uint8 arrays
+        batch = torch.stack([retrieval_transform(Image.fromarray(image) if isinstance(image, np.ndarray) else image)
+                             for image in images])
+        with torch.inference_mode():
+            z = embed(self.simclr, batch).cpu().numpy()
+        scores, ids = self.index.search(z, k or self.top_k)
+        return [[{"path": self.paths[i], "score": float(s)} for s, i in zip(row_scores, row_ids) if i >= 0]
+                for row_scores, row_ids in zip(scores, ids)]
+
+
+_retriever = None
+_retriever_lock = threading.Lock()
+
+
+def get_retriever():
+    global _retriever
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                _retriever = Retriever()
+    return _retriever
+
+
+def build_catalog(image_dir, retrieval_dir=RETRIEVAL_DIR, encoder_arch="imagenet", n_lists=256, append=False):
+    # embeds every image under image_dir and trains (or, with append, extends) the index
+    os.makedirs(retrieval_dir, exist_ok=True)
+    paths_file = os.path.join(retrieval_dir, "paths.txt")
+    index_path = os.path.join(retrieval_dir, "index.npz")
+    index, known = None, []
+    if append and os.path.exists(index_path):
+        index = IVFIndex.load(index_path)
+        with open(paths_file) as f:
+            # paths past the index size belong to an append that did not finish
+            known = f.read().splitlines()[:len(index)]
+    known_set = set(known)
+    paths = [path for path in list_images(image_dir) if path not in known_set]
+    if not paths:
+        return index_path
+
+    simclr = SimCLR(0, encoder_arch=encoder_arch)
+    simclr.load_model(SAVE_DIR)
+    # the catalog embeddings stay on disk as one memory mapped .npy part per build / append
+    part_path = os.path.join(retrieval_dir, f"embeddings_{len(known):09d}.npy")
+    vectors, embedded = extract_embeddings(simclr, ImageFiles(paths), part_path)
+    # unreadable files get no id and are listed in failed.txt, a later --append tries them again
+    failed = [paths[i] for i in np.setdiff1d(np.arange(len(paths)), embedded)]
+    paths = [paths[i] for i in embedded]
+
+    def write_failed(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write("".join(path + "\n" for path in failed))
+    atomic_write(os.path.join(retrieval_dir, "failed.txt"), write_failed)
+    if failed:
+        logging.warning(f"{len(failed)} of {len(failed) + len(paths)} images could not be read, "
+                        f"see {os.path.join(retrieval_dir, 'failed.txt')}")
+    if not paths:
+        os.remove(part_path)
+        return index_path
+    if index is None:
+        index = IVFIndex(vectors.shape[1], min(n_lists, len(vectors)))
+        index.train(vectors)
+    index.add(vectors, ids=np.arange(len(known), len(known) + len(paths)))
+    # the paths go first, an index never refers to an id without a path
+
+    def write_paths(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(known + paths) + "\n")
+    atomic_write(paths_file, write_paths)
+    index.save(index_path)
+    return index_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image_dir")
+    parser.add_argument("--encoder-arch", choices=ENCODER_ARCHS, default="imagenet")
+    parser.add_argument("--n-lists", type=int, default=256)
+    parser.add_argument("--append", action="store_true",
+                        help="add the images that are not indexed yet to the existing index")
+    args = parser.parse_args()
+    index_path = build_catalog(args.image_dir, encoder_arch=args.encoder_arch, n_lists=args.n_lists, append=args.append)
+    print(f"index written to {index_path}")
@@ -1,25 +1,105 @@
-from SimCLR import Classifier
+from SimCLR import Classifier, ENCODER_ARCHS
+from perf import VALID_PRECISIONS
+from SimCLR_Data import AUGMENTS
+from distributed import init_distributed, cleanup
+import torch.multiprocessing as mp
+import argparse
+import os
 import time
 
 
-if __name__ == "__main__":
+def main(args):
+    rank, world_size = init_distributed()
     st = time.time()
 
-    clf = Classifier(100, -1)
+    clf = Classifier(100, -1, encoder_arch=args.encoder_arch)
     clf.pretext_train("CIFAR100",
                       epochs=100,
                       enc_lr=3e-5,
                       proj_lr=3e-4,
-                      fine_tune_layers=0,
+                      fine_tune_layers=args.unfreeze_blocks,
                       temperature=0.5,
-                      batch_size=2048
+                      # the global batch of 2048 is split over the processes
+                      batch_size=2048 // world_size,
+                      augment=args.augment,
+                      precision=args.precision,
+                      channels_last=args.channels_last,
+                      micro_batch_size=args.micro_batch_size,
+                      log_interval=args.log_interval,
+                      checkpoint_every=args.checkpoint_every,
+                      keep_checkpoints=args.keep_checkpoints,
+                      resume=args.resume,
+                      knn_every=args.knn_every,
+                      prefix_cache_mb=args.prefix_cache_mb
                       )
+    cleanup()
+    # fine tuning the head is cheap, the first process does it alone
+    if rank != 0:
+        return
     clf.load_pretexted_model()
     clf.fine_tuning(dataset_name="cifar100",
                     epochs=1,
                     clf_lr=1e-4,
-                    batch_size=2048
+                    batch_size=2048,
+                    precision=args.precision,
+                    channels_last=args.channels_last,
+                    cache_features=args.cache_features,
+                    log_interval=args.log_interval,
+                    eval_batch_size=args.eval_batch_size,
+                    eval_every=args.eval_every
                     )
     ed = time.time()
     print(f"Time taken in seconds = {ed - st}")
 
+
+def spawned_main(rank, args):
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(args.nproc)
+    main(args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoder-arch", choices=ENCODER_ARCHS, default="imagenet",
+                        help="imagenet upsamples CIFAR to 224, cifar runs a 3x3-stem ResNet18 at 32x32")
+    parser.add_argument("--augment", choices=AUGMENTS, default="torchvision",
+                        help="per-image torchvision augmentations, or the batched tensor engine (faster, clamps "
+                             "oversized crops and runs colour jitter in a fixed order)")
+    parser.add_argument("--precision", choices=VALID_PRECISIONS, default="fp32",
+                        help="autocast dtype for pretext training and fine tuning")
+    parser.add_argument("--channels-last", action="store_true",
+                        help="run the ResNet18 encoder in channels_last memory format")
+    parser.add_argument("--cache-features", action="store_true",
+                        help="fine tune the classifier head on cached features of the frozen encoder")
+    parser.add_argument("--micro-batch-size", type=int, default=None,
+                        help="cache embeddings in micro batches of this size so the 2x2048 contrastive batch fits in memory")
+    parser.add_argument("--log-interval", type=int, default=10,
+                        help="print the running loss every this many batches")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue pretext training from the newest checkpoint in SimCLR/checkpoints. Weights, "
+                             "optimizer and data order are restored, the DataLoader workers' augmentation RNG is "
+                             "not, so augmentations after the resume differ from an uninterrupted run")
+    parser.add_argument("--checkpoint-every", type=int, default=None,
+                        help="also checkpoint every this many steps, not only at the end of each epoch")
+    parser.add_argument("--keep-checkpoints", type=int, default=3,
+                        help="number of newest pretext checkpoints kept on disk, at least 1")
+    parser.add_argument("--knn-every", type=int, default=None,
+                        help="report weighted kNN accuracy of the pretext embeddings every this many epochs")
+    parser.add_argument("--unfreeze-blocks", type=int, default=-1,
+                        help="pretext train only this many trailing encoder blocks (stem, layer1-4, fc), -1 for all")
+    parser.add_argument("--prefix-cache-mb", type=int, default=0,
+                        help="keep frozen-prefix outputs of the un-augmented views in this much memory")
+    parser.add_argument("--eval-batch-size", type=int, default=None,
+                        help="validation batch size, twice the training batch size by default")
+    parser.add_argument("--eval-every", type=int, default=1,
+                        help="validate every this many fine tuning epochs and after the last one, at least 1")
+    parser.add_argument("--nproc", type=int, default=1,
+                        help="pretext train with this many local processes (gloo on cpu, one gpu each otherwise), "
+                             "torchrun and srun set up the processes themselves")
+    args = parser.parse_args()
+
+    if args.nproc > 1:
+        mp.spawn(spawned_main, args=(args,), nprocs=args.nproc)
+    else:
+        main(args)
@@ -1,12 +1,18 @@
 #!/bin/bash
 #SBATCH --job-name=simCLR 	# Job name
 #SBATCH --partition=gpu2 	#Partition name can be test/small/medium/large/gpu #Partition “gpu” should be used only for gpu jobs
-#SBATCH --nodes=1 			# Run all processes on a single node
-#SBATCH --ntasks=1 			# Run a single task
+#SBATCH --nodes=1 			# Number of nodes, every process trains on its own gpu
+#SBATCH --ntasks-per-node=2 	# One task (training process) per gpu
 #SBATCH --cpus-per-task=4 	# Number of CPU cores per task
-#SBATCH --gres=gpu:1 		# Include gpu for the task (only for GPU jobs)
+#SBATCH --gres=gpu:2 		# Gpus per node, same as --ntasks-per-node
+#SBATCH --requeue 			# Put the job back in the queue when it is preempted
+#SBATCH --open-mode=append 	# Keep the output of earlier attempts
 
 
 module load python/3.8
 cd ~/dlops_proj/dlops_project_
-python3 run.py
+# the first node hosts the process group, srun gives each task its SLURM_PROCID/SLURM_LOCALID
+export MASTER_ADDR=$(scontrol show hostnames "$SLURM_JOB_NODELIST" | head -n 1)
+export MASTER_PORT=29500
+# --resume picks up the newest checkpoint after a preemption or a resubmitted timeout
+srun python3 run.py --resume --checkpoint-every 10